@@ -3,15 +3,15 @@ import json
 import logging
 from datetime import datetime
 from importlib import import_module
-from typing import Any, Dict, NoReturn, Optional
+from typing import Any, Dict, List, NoReturn, Optional
 
 import boto3
 from omegaconf import OmegaConf
 from sagemaker import ModelPackage, Predictor, Session
 from sagemaker.model_monitor import DataCaptureConfig
-from sagemaker.workflow.pipeline_context import PipelineSession
+from sagemaker.workflow.pipeline_context import LocalPipelineSession, PipelineSession
 
-from mlops_utilities import helpers
+from mlops_utilities import datasets, helpers, local
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +25,7 @@ def upsert_pipeline(
     *args,
     pipeline_tags: Optional[Dict[str, str]] = None,
     dryrun: bool = False,
+    local_mode: bool = False,
 ) -> NoReturn:
     """
     Performs Sagemaker pipeline creating or updating.
@@ -50,6 +51,8 @@ def upsert_pipeline(
     :param pipeline_name: the name of the pipeline
     :param pipeline_tags: {"<key>": "<value>", ...} dict to be set as SM pipeline resource tags
     :param dryrun: whether to skip actual pipeline upsert or not
+    :param local_mode: build the pipeline with a local pipeline session and store its definition
+        locally (see `mlops_utilities.local`) instead of upserting it to Sagemaker
     :param args: extra configuration to pass to pipeline building;
         must follow dot-notation (https://omegaconf.readthedocs.io/en/2.0_branch/usage.html#from-a-dot-list)
     """
@@ -60,7 +63,8 @@ def upsert_pipeline(
 
     if logger.isEnabledFor(logging.INFO):
         logger.info("Result config:\n%s", OmegaConf.to_yaml(result_conf, resolve=True))
-    sm_session = PipelineSession(
+    session_cls = LocalPipelineSession if local_mode else PipelineSession
+    sm_session = session_cls(
         default_bucket=OmegaConf.select(
             result_conf, "pipeline.default_bucket", default=None
         )
@@ -76,7 +80,10 @@ def upsert_pipeline(
             json.dumps(json.loads(pipeline_object.definition()), indent=2),
         )
 
-    if not dryrun:
+    if local_mode:
+        if not dryrun:
+            local.save_pipeline_definition(pipeline_name, pipeline_object.definition())
+    elif not dryrun:
         if pipeline_tags is not None:
             pipeline_tags = helpers.convert_param_dict_to_key_value_list(pipeline_tags)
         pipeline_object.upsert(result_conf.pipeline.role, tags=pipeline_tags)
@@ -87,6 +94,8 @@ def run_pipeline(
     execution_name_prefix: str,
     pipeline_params: Dict[str, Any],
     dryrun=False,
+    local_mode: bool = False,
+    dataset_params: Optional[List[str]] = None,
 ) -> str:
     """
     Performs Sagemaker pipeline running.
@@ -99,7 +108,18 @@ def run_pipeline(
     :param execution_name_prefix: prefix for pipeline running job
     :param dryrun: should be run in test mode without real execution. If true then the method returns only arguments
     :param pipeline_params: additional parameters for pipeline
+    :param local_mode: execute the pipeline previously upserted with `local_mode=True` on this machine;
+        steps with unchanged inputs are taken from the local cache
+    :param dataset_params: names of `pipeline_params` holding dataset S3 URIs; each dataset gets versioned
+        (see `mlops_utilities.datasets`) and its version is passed as `<param name>Version` pipeline parameter
     """
+    if dataset_params:
+        # dry run shows dataset versions but leaves the version history untouched
+        pipeline_params = datasets.add_dataset_versions(
+            pipeline_params, dataset_params, dryrun=dryrun
+        )
+    if local_mode:
+        return _run_local_pipeline(pipeline_name, pipeline_params, dryrun)
     sagemaker_client = boto3.client(
         "sagemaker"
     )  # Can not be cut off because it could not be presented as string
@@ -118,6 +138,29 @@ def run_pipeline(
     return sagemaker_client.start_pipeline_execution(**start_pipe_args)
 
 
+def _run_local_pipeline(
+    pipeline_name: str, pipeline_params: Dict[str, Any], dryrun: bool = False
+) -> Dict[str, Any]:
+    """
+    Run locally stored pipeline definition
+    :param pipeline_name: locally upserted pipeline name
+    :param pipeline_params: additional parameters for pipeline
+    :param dryrun: return steps which would be executed without running them
+    :return: step name -> step status
+    """
+    definition = local.load_pipeline_definition(pipeline_name)
+    if dryrun:
+        return {step["Name"]: step["Type"] for step in definition["Steps"]}
+    runner = local.LocalPipelineRunner(
+        definition, local.get_pipeline_dir(pipeline_name) / "steps"
+    )
+    results = runner.run(pipeline_params)
+    if logger.isEnabledFor(logging.INFO):
+        for result in results.values():
+            logger.info("Step %s: %s %s", result.name, result.status, result.outputs)
+    return {name: result.status for name, result in results.items()}
+
+
 def deploy_model(
     sagemaker_session: Session,
     model_package_group_name: str,
@@ -0,0 +1,338 @@
+"""Garbage collection of Sagemaker resources left behind by deployments"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from botocore.client import BaseClient  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
+
+from mlops_utilities import helpers
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:  # pylint: disable=too-few-public-methods
+    """Token bucket shared by worker threads to keep Sagemaker API calls under the account limits"""
+
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        """
+        :param requests_per_second: sustained request rate
+        :param burst: max number of requests allowed at once
+        """
+        self.interval = 1.0 / requests_per_second
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a request is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) / self.interval
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) * self.interval
+            time.sleep(wait_time)
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    Rules protecting unreferenced resources from deletion
+
+    :param keep_last: number of the most recent unreferenced resources of each type to keep
+    :param min_age: resources created less than `min_age` ago are kept
+    :param keep_tags: resources having any of these tags are kept, tag value None matches any value
+    """
+
+    keep_last: int = 10
+    min_age: timedelta = timedelta(days=7)
+    keep_tags: Dict[str, Optional[str]] = field(default_factory=dict)
+
+
+@dataclass
+class ReferenceGraph:
+    """Edges endpoint -> endpoint configs -> models -> model packages"""
+
+    endpoint_configs: Dict[str, Set[str]] = field(default_factory=dict)
+    config_models: Dict[str, Set[str]] = field(default_factory=dict)
+    model_packages: Dict[str, Set[str]] = field(default_factory=dict)
+
+    @property
+    def referenced_configs(self) -> Set[str]:
+        """Endpoint configs used by endpoints"""
+        return set().union(*self.endpoint_configs.values())
+
+    @property
+    def referenced_models(self) -> Set[str]:
+        """Models used by endpoint configs"""
+        return set().union(*self.config_models.values())
+
+    @property
+    def referenced_packages(self) -> Set[str]:
+        """Model packages used by models"""
+        return set().union(*self.model_packages.values())
+
+
+@dataclass
+class CleanupReport:
+    """Resources selected for deletion and the outcome of the deletion"""
+
+    dryrun: bool
+    endpoint_configs: List[str] = field(default_factory=list)
+    models: List[str] = field(default_factory=list)
+    kept: Dict[str, int] = field(default_factory=dict)
+    referenced_packages: List[str] = field(default_factory=list)
+    # (resource type, name) -> error, e.g. ("endpoint_config", "my-config")
+    failed: Dict[Tuple[str, str], str] = field(default_factory=dict)
+
+    def summary(self) -> str:
+        """
+        Human readable report
+        :return: report text
+        """
+        action = "Would delete" if self.dryrun else "Deleted"
+        lines = [
+            f"{action} {len(self.endpoint_configs)} endpoint configs, {len(self.models)} models",
+            f"Kept: {self.kept}",
+            f"Model packages referenced by kept models: {len(self.referenced_packages)}",
+        ]
+        lines += [f"  endpoint config {name}" for name in self.endpoint_configs]
+        lines += [f"  model {name}" for name in self.models]
+        lines += [
+            f"Failed {resource_type.replace('_', ' ')} {name}: {error}"
+            for (resource_type, name), error in self.failed.items()
+        ]
+        return "\n".join(lines)
+
+
+class SagemakerGarbageCollector:  # pylint: disable=too-few-public-methods
+    """
+    Finds models and endpoint configs which are not used by any endpoint and deletes them.
+
+    Example:
+    >>> collector = SagemakerGarbageCollector(boto3.client("sagemaker"), RetentionPolicy(keep_last=5))
+    >>> print(collector.collect(dryrun=True).summary())
+    """
+
+    def __init__(
+        self,
+        sagemaker_client: BaseClient,
+        policy: Optional[RetentionPolicy] = None,
+        max_workers: int = 8,
+        requests_per_second: float = 5.0,
+    ):
+        """
+        :param sagemaker_client: An instance of `boto3.client("sagemaker")`.
+        :param policy: retention rules, `RetentionPolicy()` defaults if not set
+        :param max_workers: number of concurrent describe/delete calls
+        :param requests_per_second: rate limit for all Sagemaker API calls made by the collector
+        """
+        self.sagemaker_client = sagemaker_client
+        self.policy = policy or RetentionPolicy()
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second, burst=max_workers)
+
+    def collect(
+        self, dryrun: bool = True, now: Optional[datetime] = None
+    ) -> CleanupReport:
+        """
+        Build reference graph, select unreferenced resources according to the retention policy
+        and delete them (endpoint configs first, then models).
+        :param dryrun: only report resources which would be deleted
+        :param now: reference time for `RetentionPolicy.min_age`, current time if not set
+        :return: cleanup report
+        """
+        now = now or datetime.now(timezone.utc)
+        graph = ReferenceGraph()
+        report = CleanupReport(dryrun=dryrun)
+
+        endpoints = self._list("list_endpoints", "Endpoints")
+        graph.endpoint_configs = dict(
+            zip(
+                (e["EndpointName"] for e in endpoints),
+                self._map(self._describe_endpoint, endpoints),
+            )
+        )
+        configs = self._list("list_endpoint_configs", "EndpointConfigs")
+        stale_configs = self._select_stale(
+            configs,
+            "EndpointConfigName",
+            "EndpointConfigArn",
+            graph.referenced_configs,
+            now,
+        )
+        kept_configs = [
+            c["EndpointConfigName"]
+            for c in configs
+            if c["EndpointConfigName"] not in stale_configs
+        ]
+        graph.config_models = dict(
+            zip(kept_configs, self._map(self._describe_endpoint_config, kept_configs))
+        )
+
+        models = self._list("list_models", "Models")
+        stale_models = self._select_stale(
+            models, "ModelName", "ModelArn", graph.referenced_models, now
+        )
+        kept_models = [
+            m["ModelName"] for m in models if m["ModelName"] not in stale_models
+        ]
+        graph.model_packages = dict(
+            zip(kept_models, self._map(self._describe_model, kept_models))
+        )
+
+        report.endpoint_configs = sorted(stale_configs)
+        report.models = sorted(stale_models)
+        report.kept = {
+            "endpoints": len(endpoints),
+            "endpoint_configs": len(kept_configs),
+            "models": len(kept_models),
+        }
+        if not dryrun:
+            self._delete_stale(graph, report)
+        report.referenced_packages = sorted(graph.referenced_packages)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Cleanup report:\n%s", report.summary())
+        return report
+
+    def _call(self, operation: str, **kwargs) -> Dict[str, Any]:
+        self.rate_limiter.acquire()
+        return getattr(self.sagemaker_client, operation)(**kwargs)
+
+    def _map(self, func: Callable, items: Iterable) -> List:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(func, items))
+
+    def _list(self, operation: str, result_key: str, **kwargs) -> List[Dict[str, Any]]:
+        pages = iter(self.sagemaker_client.get_paginator(operation).paginate(**kwargs))
+        result = []
+        while True:
+            self.rate_limiter.acquire()
+            page = next(pages, None)
+            if page is None:
+                return result
+            result += page[result_key]
+
+    def _describe_endpoint(self, endpoint: Dict[str, Any]) -> Set[str]:
+        try:
+            description = self._call(
+                "describe_endpoint", EndpointName=endpoint["EndpointName"]
+            )
+        except ClientError as error:
+            if helpers.is_not_found_error(error):
+                return set()
+            raise
+        configs = {description["EndpointConfigName"]}
+        # endpoint being updated is going to use the new config
+        pending = description.get("PendingDeploymentSummary", {})
+        if "EndpointConfigName" in pending:
+            configs.add(pending["EndpointConfigName"])
+        return configs
+
+    def _describe_endpoint_config(self, config_name: str) -> Set[str]:
+        try:
+            description = self._call(
+                "describe_endpoint_config", EndpointConfigName=config_name
+            )
+        except ClientError as error:
+            # resource deleted since listed, any other error must not make its references look unused
+            if helpers.is_not_found_error(error):
+                return set()
+            raise
+        variants = description.get("ProductionVariants", []) + description.get(
+            "ShadowProductionVariants", []
+        )
+        return {v["ModelName"] for v in variants if "ModelName" in v}
+
+    def _describe_model(self, model_name: str) -> Set[str]:
+        try:
+            description = self._call("describe_model", ModelName=model_name)
+        except ClientError as error:
+            if helpers.is_not_found_error(error):
+                return set()
+            raise
+        containers = description.get("Containers", [])
+        if "PrimaryContainer" in description:
+            containers = containers + [description["PrimaryContainer"]]
+        return {c["ModelPackageName"] for c in containers if "ModelPackageName" in c}
+
+    def _select_stale(
+        self,
+        resources: List[Dict[str, Any]],
+        name_key: str,
+        arn_key: str,
+        referenced: Set[str],
+        now: datetime,
+    ) -> Set[str]:
+        unreferenced = sorted(
+            (r for r in resources if r[name_key] not in referenced),
+            key=lambda r: r["CreationTime"],
+            reverse=True,
+        )
+        candidates = [
+            r
+            for r in unreferenced[self.policy.keep_last :]
+            if now - r["CreationTime"] >= self.policy.min_age
+        ]
+        if self.policy.keep_tags:
+            protected = self._map(lambda r: self._has_keep_tag(r[arn_key]), candidates)
+            candidates = [r for r, keep in zip(candidates, protected) if not keep]
+        return {r[name_key] for r in candidates}
+
+    def _has_keep_tag(self, arn: str) -> bool:
+        tags = self._list("list_tags", "Tags", ResourceArn=arn)
+        return any(
+            tag["Key"] in self.policy.keep_tags
+            and self.policy.keep_tags[tag["Key"]] in (None, tag["Value"])
+            for tag in tags
+        )
+
+    def _delete_stale(self, graph: ReferenceGraph, report: CleanupReport) -> None:
+        """Delete endpoint configs, then models which are not used by the configs failed to delete"""
+        self._delete(
+            "delete_endpoint_config",
+            "EndpointConfigName",
+            report.endpoint_configs,
+            report,
+        )
+        failed_configs = [
+            c
+            for c in report.endpoint_configs
+            if ("endpoint_config", c) in report.failed
+        ]
+        still_referenced = set().union(
+            *self._map(self._describe_endpoint_config, failed_configs)
+        )
+        retained = [m for m in report.models if m in still_referenced]
+        if retained:
+            report.models = [m for m in report.models if m not in still_referenced]
+            report.kept["models"] += len(retained)
+            graph.model_packages.update(
+                zip(retained, self._map(self._describe_model, retained))
+            )
+        self._delete("delete_model", "ModelName", report.models, report)
+
+    def _delete(
+        self, operation: str, name_arg: str, names: List[str], report: CleanupReport
+    ) -> None:
+        # configs and models may share names, failures are keyed by resource type as well
+        resource_type = operation[len("delete_") :]
+
+        def delete(name: str) -> None:
+            try:
+                self._call(operation, **{name_arg: name})
+            except ClientError as error:
+                report.failed[(resource_type, name)] = str(error)
+
+        self._map(delete, names)
@@ -0,0 +1,389 @@
+"""Dataset versioning for S3 prefixes"""
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote, unquote
+
+import boto3  # type: ignore
+from botocore.client import BaseClient  # type: ignore
+
+from mlops_utilities import helpers
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MANIFEST_DIR = os.environ.get("MLOPS_MANIFEST_DIR", ".mlops_datasets")
+LATEST_FILE_NAME = "LATEST"
+VERSION_PARAM_SUFFIX = "Version"
+
+# version digest is a sum of entry digests, so it can be updated by changed entries only
+_DIGEST_MODULO = 1 << 256
+# keys are percent-encoded only for the characters which break the manifest line format
+_KEY_SAFE_CHARS = "".join(chr(c) for c in range(32, 127) if chr(c) != "%")
+# max number of partition files open at once, larger listings are merged in rounds
+_MAX_OPEN_PARTS = 256
+
+
+class ManifestEntry(NamedTuple):
+    """S3 object as recorded in the dataset manifest"""
+
+    key: str
+    size: int
+    etag: str
+
+
+@dataclass
+class DatasetManifest:
+    """
+    Dataset version descriptor.
+    Entries are kept on disk (gzipped, sorted by key) and streamed on demand.
+    """
+
+    s3_uri: str
+    digest: str
+    object_count: int
+    total_size: int
+    entries_path: str
+
+    @property
+    def version(self) -> str:
+        """Short dataset version identifier"""
+        return self.digest[:16]
+
+    def entries(self) -> Iterator[ManifestEntry]:
+        """
+        Iterate manifest entries in key order
+        :return: entries iterator
+        """
+        with gzip.open(self.entries_path, "rt", encoding="utf-8") as entries_file:
+            for line in entries_file:
+                yield _decode_entry(line)
+
+
+@dataclass
+class ManifestDiff:
+    """Number of objects changed since the previous dataset version"""
+
+    added: int = 0
+    removed: int = 0
+    modified: int = 0
+
+
+def build_manifest(
+    s3_client: BaseClient,
+    s3_uri: str,
+    manifest_dir: str,
+    previous: Optional[DatasetManifest] = None,
+    max_workers: int = 8,
+    partition_depth: int = 1,
+) -> Tuple[DatasetManifest, ManifestDiff]:
+    """
+    List S3 prefix and build its manifest.
+
+    Listing is split by sub-prefixes ("/" delimited, up to `partition_depth` levels)
+    which are paginated concurrently and spilled to disk, so memory usage does not
+    depend on the number of objects.
+    If `previous` manifest is given, only added, removed and modified objects
+    contribute to the version digest update.
+
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param s3_uri: dataset S3 prefix, e.g. "s3://my-bucket/datasets/abalone/"
+    :param manifest_dir: directory to store the manifest in
+    :param previous: manifest of the previous version of the same dataset
+    :param max_workers: max number of concurrent listing requests
+    :param partition_depth: how many sub-prefix levels are listed concurrently
+    :return: new manifest and the difference with the previous one
+    """
+    Path(manifest_dir).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=manifest_dir) as tmp_dir:
+        part_paths = _PrefixLister(s3_client, Path(tmp_dir), max_workers).list(
+            s3_uri, partition_depth
+        )
+        entries_path = Path(tmp_dir) / "entries.tsv.gz"
+        digest, diff, count, total_size = _write_entries(
+            entries_path,
+            _merge_parts(part_paths),
+            previous.entries() if previous is not None else iter(()),
+            int(previous.digest, 16) if previous is not None else 0,
+        )
+        manifest = DatasetManifest(
+            s3_uri=s3_uri,
+            digest=digest,
+            object_count=count,
+            total_size=total_size,
+            entries_path=str(Path(manifest_dir) / f"{digest}.tsv.gz"),
+        )
+        shutil.move(str(entries_path), manifest.entries_path)
+    Path(manifest_dir, f"{digest}.json").write_text(
+        json.dumps(asdict(manifest)), encoding="utf-8"
+    )
+    return manifest, diff
+
+
+def load_manifest(manifest_dir: str, digest: str) -> DatasetManifest:
+    """
+    Load stored manifest
+    :param manifest_dir: directory with dataset manifests
+    :param digest: manifest digest
+    :return: dataset manifest
+    """
+    return DatasetManifest(
+        **json.loads(Path(manifest_dir, f"{digest}.json").read_text(encoding="utf-8"))
+    )
+
+
+def load_latest_manifest(manifest_dir: str) -> Optional[DatasetManifest]:
+    """
+    Load the most recently built manifest
+    :param manifest_dir: directory with dataset manifests
+    :return: dataset manifest or None if the dataset was never versioned
+    """
+    latest_path = Path(manifest_dir, LATEST_FILE_NAME)
+    if not latest_path.exists():
+        return None
+    return load_manifest(manifest_dir, latest_path.read_text(encoding="utf-8").strip())
+
+
+def get_dataset_manifest_dir(s3_uri: str, manifest_root: Optional[str] = None) -> str:
+    """
+    Directory which keeps manifests of all versions of the dataset
+    :param s3_uri: dataset S3 prefix
+    :param manifest_root: root directory for manifests, `DEFAULT_MANIFEST_DIR` if not set
+    :return: directory path
+    """
+    return str(Path(manifest_root or DEFAULT_MANIFEST_DIR) / quote(s3_uri, safe=""))
+
+
+def version_dataset(
+    s3_uri: str,
+    manifest_root: Optional[str] = None,
+    s3_client: Optional[BaseClient] = None,
+    max_workers: int = 8,
+    dryrun: bool = False,
+) -> DatasetManifest:
+    """
+    Build new version of the dataset manifest incrementally against the latest one.
+
+    Example:
+    >>> version_dataset('s3://mlops-sagemaker-project/abalonedata/').version
+    '5e0f0e2c4d6a1b39'
+
+    :param s3_uri: dataset S3 prefix
+    :param manifest_root: root directory for manifests, `DEFAULT_MANIFEST_DIR` if not set
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param max_workers: max number of concurrent listing requests
+    :param dryrun: compute the version only, the manifest is not stored and the latest version is not updated
+    :return: dataset manifest (without entries in dry run)
+    """
+    manifest_dir = get_dataset_manifest_dir(s3_uri, manifest_root)
+    with ExitStack() as stack:
+        manifest, diff = build_manifest(
+            s3_client or boto3.client("s3"),
+            s3_uri,
+            stack.enter_context(tempfile.TemporaryDirectory())
+            if dryrun
+            else manifest_dir,
+            previous=load_latest_manifest(manifest_dir),
+            max_workers=max_workers,
+        )
+    if not dryrun:
+        Path(manifest_dir, LATEST_FILE_NAME).write_text(
+            manifest.digest, encoding="utf-8"
+        )
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "Dataset %s version %s: %d objects, %s",
+            s3_uri,
+            manifest.version,
+            manifest.object_count,
+            diff,
+        )
+    return manifest
+
+
+def add_dataset_versions(
+    pipeline_params: Dict[str, Any],
+    dataset_params: Iterable[str],
+    manifest_root: Optional[str] = None,
+    s3_client: Optional[BaseClient] = None,
+    dryrun: bool = False,
+) -> Dict[str, Any]:
+    """
+    Version datasets passed as pipeline parameters
+    and add their versions as `<parameter name>Version` parameters.
+
+    :param pipeline_params: pipeline parameters
+    :param dataset_params: names of pipeline parameters holding dataset S3 URIs
+    :param manifest_root: root directory for manifests, `DEFAULT_MANIFEST_DIR` if not set
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param dryrun: compute versions without storing manifests and updating latest versions
+    :return: pipeline parameters extended with dataset versions
+    """
+    result = dict(pipeline_params)
+    for param_name in dataset_params:
+        result[f"{param_name}{VERSION_PARAM_SUFFIX}"] = version_dataset(
+            pipeline_params[param_name], manifest_root, s3_client, dryrun=dryrun
+        ).version
+    return result
+
+
+class _PrefixLister:  # pylint: disable=too-few-public-methods
+    """Lists S3 prefix concurrently by sub-prefixes, each partition is spilled to its own file"""
+
+    def __init__(self, s3_client: BaseClient, tmp_dir: Path, max_workers: int):
+        self.s3_client = s3_client
+        self.bucket = None
+        self.tmp_dir = tmp_dir
+        self.max_workers = max_workers
+        self._part_numbers = itertools.count()
+
+    def list(self, s3_uri: str, partition_depth: int) -> List[Path]:
+        """
+        :param s3_uri: S3 prefix
+        :param partition_depth: how many sub-prefix levels are listed concurrently
+        :return: paths of files with sorted entries, partitions do not overlap
+        """
+        self.bucket, prefix = helpers.split_s3_uri(s3_uri)
+        part_paths = []
+        prefixes = [prefix]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for _ in range(partition_depth):
+                levels = list(executor.map(self._list_level, prefixes))
+                part_paths += [part_path for part_path, _ in levels]
+                prefixes = [p for _, common in levels for p in common]
+            part_paths += list(executor.map(self._list_all, prefixes))
+        return part_paths
+
+    def _new_part_path(self) -> Path:
+        return self.tmp_dir / f"part-{next(self._part_numbers):06d}.tsv"
+
+    def _list_level(self, prefix: str) -> Tuple[Path, List[str]]:
+        """Objects directly under the prefix and its sub-prefixes"""
+        part_path = self._new_part_path()
+        common_prefixes = []
+        with open(part_path, "wt", encoding="utf-8") as part_file:
+            for page in self._pages(Prefix=prefix, Delimiter="/"):
+                _write_objects(part_file, page)
+                common_prefixes += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+        return part_path, common_prefixes
+
+    def _list_all(self, prefix: str) -> Path:
+        part_path = self._new_part_path()
+        with open(part_path, "wt", encoding="utf-8") as part_file:
+            for page in self._pages(Prefix=prefix):
+                _write_objects(part_file, page)
+        return part_path
+
+    def _pages(self, **kwargs) -> Iterator[Dict[str, Any]]:
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        return paginator.paginate(Bucket=self.bucket, **kwargs)
+
+
+def _write_objects(part_file, page: Dict[str, Any]) -> None:
+    for obj in page.get("Contents", []):
+        part_file.write(
+            _encode_entry(
+                ManifestEntry(obj["Key"], obj["Size"], obj["ETag"].strip('"'))
+            )
+        )
+
+
+def _merge_parts(part_paths: List[Path]) -> Iterator[ManifestEntry]:
+    """
+    Merge sorted partitions into a single key ordered stream.
+    Partitions are merged in groups of `_MAX_OPEN_PARTS` into intermediate files
+    until a single group is left, so the number of open files is bounded.
+    """
+    for round_number in itertools.count():
+        if len(part_paths) <= _MAX_OPEN_PARTS:
+            break
+        merged_paths = []
+        for start in range(0, len(part_paths), _MAX_OPEN_PARTS):
+            group = part_paths[start : start + _MAX_OPEN_PARTS]
+            merged_path = group[0].with_name(
+                f"merged-{round_number:03d}-{len(merged_paths):06d}.tsv"
+            )
+            with open(merged_path, "wt", encoding="utf-8") as merged_file:
+                merged_file.writelines(_merge_lines(group))
+            for part_path in group:
+                part_path.unlink()
+            merged_paths.append(merged_path)
+        part_paths = merged_paths
+    for line in _merge_lines(part_paths):
+        yield _decode_entry(line)
+
+
+def _merge_lines(part_paths: List[Path]) -> Iterator[str]:
+    with ExitStack() as stack:
+        part_files = [
+            stack.enter_context(open(part_path, "rt", encoding="utf-8"))
+            for part_path in part_paths
+        ]
+        yield from heapq.merge(*part_files, key=_line_key)
+
+
+def _write_entries(
+    entries_path: Path,
+    listed: Iterator[ManifestEntry],
+    previous: Iterator[ManifestEntry],
+    previous_digest: int,
+) -> Tuple[str, ManifestDiff, int, int]:
+    """
+    Write listed entries and update previous digest
+    by merge-joining both key ordered entry streams
+    """
+    digest = previous_digest
+    diff = ManifestDiff()
+    count = total_size = 0
+    old = next(previous, None)
+    with gzip.open(entries_path, "wt", encoding="utf-8") as entries_file:
+        for entry in listed:
+            while old is not None and old.key < entry.key:
+                digest -= _entry_digest(old)
+                diff.removed += 1
+                old = next(previous, None)
+            if old is not None and old.key == entry.key:
+                if old != entry:
+                    digest += _entry_digest(entry) - _entry_digest(old)
+                    diff.modified += 1
+                old = next(previous, None)
+            else:
+                digest += _entry_digest(entry)
+                diff.added += 1
+            entries_file.write(_encode_entry(entry))
+            count += 1
+            total_size += entry.size
+    while old is not None:
+        digest -= _entry_digest(old)
+        diff.removed += 1
+        old = next(previous, None)
+    return f"{digest % _DIGEST_MODULO:064x}", diff, count, total_size
+
+
+def _entry_digest(entry: ManifestEntry) -> int:
+    return int.from_bytes(
+        hashlib.sha256(_encode_entry(entry).encode("utf-8")).digest(), "big"
+    )
+
+
+def _encode_entry(entry: ManifestEntry) -> str:
+    return f"{quote(entry.key, safe=_KEY_SAFE_CHARS)}\t{entry.size}\t{entry.etag}\n"
+
+
+def _decode_entry(line: str) -> ManifestEntry:
+    key, size, etag = line.rstrip("\n").split("\t")
+    return ManifestEntry(unquote(key), int(size), etag)
+
+
+def _line_key(line: str) -> str:
+    return unquote(line[: line.index("\t")])
@@ -2,19 +2,27 @@
 import json
 import logging
 import operator
+import re
 from datetime import datetime
 from functools import reduce
 from pathlib import Path
-from typing import Any, Dict, List, Mapping
+from typing import Any, Dict, Iterator, List, Mapping, Set, Tuple
 
 import boto3  # type: ignore
 from botocore.client import BaseClient  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
 from omegaconf import OmegaConf, dictconfig
 
 # Sagemaker dependent methods
 
 logger = logging.getLogger(__name__)
 
+# name of the step referenced by a pipeline definition property, e.g. Steps.Train.ModelArtifacts
+STEP_REF_PATTERN = re.compile(r"^Steps\.([^.\[]+)")
+
+# messages of ValidationException raised by describe calls of missing resources
+_NOT_FOUND_PHRASES = ("Could not find", "does not exist")
+
 
 def get_pipeline_config(
         pipeline_module, config_type: str, pipeline_role: str, args: List
@@ -102,7 +110,7 @@ def load_json_from_s3(s3_uri: str) -> Dict:
     :return: The contents of the JSON file as a dictionary.
     """
     s3_client = boto3.client("s3")
-    bucket, key = s3_uri.replace("s3://", "").split("/", 1)
+    bucket, key = split_s3_uri(s3_uri)
     s3_response_object = s3_client.get_object(Bucket=bucket, Key=key)
 
     return json.loads(s3_response_object["Body"].read().decode("utf-8"))
@@ -190,6 +198,32 @@ def normalize_key(key: str) -> str:
     return key.replace("_", "").lower()
 
 
+def split_s3_uri(s3_uri: str) -> Tuple[str, str]:
+    """
+    Split S3 URI into bucket and key
+    :param s3_uri: "s3://my-bucket/path/to/file.json"
+    :return: ("my-bucket", "path/to/file.json")
+    """
+    bucket, _, key = s3_uri.replace("s3://", "", 1).partition("/")
+    return bucket, key
+
+
+def is_not_found_error(error: ClientError) -> bool:
+    """
+    Sagemaker reports missing resources as ResourceNotFound or as ValidationException
+    with "Could not find ..." (jobs, models, endpoints, endpoint configs)
+    or "... does not exist" (model packages) message
+    :param error: boto3 client error
+    :return: True if the described resource does not exist
+    """
+    code = error.response["Error"]["Code"]
+    message = error.response["Error"].get("Message", "")
+    return code == "ResourceNotFound" or (
+        code == "ValidationException"
+        and any(phrase in message for phrase in _NOT_FOUND_PHRASES)
+    )
+
+
 def get_model_name(model_arn: str) -> str:
     """
     Get model name from ARN
@@ -208,6 +242,63 @@ def get_job_name(job_arn: str) -> str:
     return job_arn[job_arn.rindex("/") + 1:]
 
 
+def get_step_dependencies(definition: Dict[str, Any]) -> Dict[str, Set[str]]:
+    """
+    Steps each top level step of the pipeline depends on,
+    either explicitly (DependsOn) or by referencing their properties
+    :param definition: pipeline definition (parsed `Pipeline.definition()` JSON)
+    :return: step name -> names of upstream steps
+    :raises ValueError: if a step depends on a step missing in the definition
+    """
+    step_names = {step["Name"] for step in definition.get("Steps", [])}
+    dependencies = {}
+    for step in definition.get("Steps", []):
+        # steps of condition branches are part of the condition step,
+        # references between them are not dependencies of the condition
+        nested_names = _nested_step_names(step)
+        step_dependencies = set(step.get("DependsOn", []))
+        for ref in iter_refs(step.get("Arguments", {})):
+            match = STEP_REF_PATTERN.match(ref)
+            if match and match.group(1) not in nested_names:
+                step_dependencies.add(match.group(1))
+        unknown = step_dependencies - step_names
+        if unknown:
+            raise ValueError(f"Step {step['Name']} depends on unknown steps {unknown}")
+        dependencies[step["Name"]] = step_dependencies
+    return dependencies
+
+
+def _nested_step_names(step: Dict[str, Any]) -> Set[str]:
+    """
+    Names of steps nested in the branches of a condition step
+    :param step: pipeline definition step
+    :return: names of IfSteps/ElseSteps, including deeper nested ones
+    """
+    arguments = step.get("Arguments", {})
+    names = set()
+    for nested in arguments.get("IfSteps", []) + arguments.get("ElseSteps", []):
+        names.add(nested["Name"])
+        names |= _nested_step_names(nested)
+    return names
+
+
+def iter_refs(value: Any) -> Iterator[str]:
+    """
+    Property references ({"Get": ...}) in pipeline definition values
+    :param value: part of pipeline definition
+    :return: referenced names, e.g. "Steps.Train.ModelArtifacts.S3ModelArtifacts"
+    """
+    if isinstance(value, list):
+        for item in value:
+            yield from iter_refs(item)
+    elif isinstance(value, dict):
+        if set(value) == {"Get"}:
+            yield value["Get"]
+        else:
+            for item in value.values():
+                yield from iter_refs(item)
+
+
 def _list_to_dict(
         arg_list: List[Dict[str, Any]], dict_key_attr: str
 ) -> Dict[Any, Dict]:
@@ -0,0 +1,624 @@
+"""Lineage graph of pipeline executions, jobs, artifacts, model packages, models and endpoints"""
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from botocore.client import BaseClient  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
+
+from mlops_utilities import helpers
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_EXECUTION = "pipeline-execution"
+PROCESSING_JOB = "processing-job"
+TRAINING_JOB = "training-job"
+TRANSFORM_JOB = "transform-job"
+ARTIFACT = "artifact"
+MODEL_PACKAGE = "model-package"
+MODEL = "model"
+ENDPOINT_CONFIG = "endpoint-config"
+ENDPOINT = "endpoint"
+
+# statuses after which a resource and its edges never change
+_TERMINAL_STATUSES = {"Completed", "Failed", "Stopped", "Succeeded"}
+
+_JOB_DESCRIPTIONS = {
+    PROCESSING_JOB: ("describe_processing_job", "ProcessingJobName"),
+    TRAINING_JOB: ("describe_training_job", "TrainingJobName"),
+    TRANSFORM_JOB: ("describe_transform_job", "TransformJobName"),
+}
+_JOB_STATUS_KEYS = {
+    PROCESSING_JOB: "ProcessingJobStatus",
+    TRAINING_JOB: "TrainingJobStatus",
+    TRANSFORM_JOB: "TransformJobStatus",
+}
+_STEP_METADATA_TYPES = {
+    "ProcessingJob": PROCESSING_JOB,
+    "TrainingJob": TRAINING_JOB,
+    "TransformJob": TRANSFORM_JOB,
+    "RegisterModel": MODEL_PACKAGE,
+    "Model": MODEL,
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    created REAL,
+    complete INTEGER NOT NULL DEFAULT 0,
+    properties TEXT
+);
+CREATE INDEX IF NOT EXISTS nodes_type ON nodes (type);
+CREATE TABLE IF NOT EXISTS edges (
+    src TEXT NOT NULL,
+    dst TEXT NOT NULL,
+    PRIMARY KEY (src, dst)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS edges_dst ON edges (dst, src);
+"""
+
+_TRAVERSAL_QUERY = """
+WITH RECURSIVE walk(id, depth) AS (
+    SELECT ?, 0
+    UNION
+    SELECT edges.{next_column}, walk.depth + 1
+    FROM edges JOIN walk ON edges.{this_column} = walk.id
+    WHERE walk.depth < ?
+)
+SELECT nodes.id, nodes.type, nodes.name, nodes.created, nodes.properties, MIN(walk.depth)
+FROM walk JOIN nodes ON nodes.id = walk.id
+WHERE walk.depth > 0
+GROUP BY nodes.id
+ORDER BY MIN(walk.depth), nodes.id
+"""
+
+
+def node_id(node_type: str, name: str) -> str:
+    """
+    Graph node identifier, Sagemaker names are case-insensitive (ARNs contain them lower-cased)
+    :param node_type: one of node type constants, e.g. `MODEL`
+    :param name: resource name, ARN for model packages and pipeline executions, S3 URI for artifacts
+    :return: node id
+    """
+    if node_type == ARTIFACT:
+        return f"{node_type}:{name.rstrip('/')}"
+    return f"{node_type}:{name.lower()}"
+
+
+@dataclass
+class LineageNode:
+    """Graph node"""
+
+    id: str  # pylint: disable=invalid-name
+    type: str
+    name: str
+    created: Optional[float] = None
+    properties: Dict[str, Any] = field(default_factory=dict)
+    depth: int = 0
+
+
+class LineageGraph:
+    """
+    Lineage graph stored in SQLite, edges point downstream (from inputs to what was produced out of them).
+    Traversal queries are recursive CTEs over indexed edges and run locally.
+    """
+
+    def __init__(self, db_path: str = ":memory:"):
+        """
+        :param db_path: SQLite database file, in-memory database by default
+        """
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        """Close the database"""
+        self.connection.close()
+
+    def add_node(
+        self,
+        node_type: str,
+        name: str,
+        created: Optional[float] = None,
+        complete: bool = False,
+        properties: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        Insert or update node
+        :param node_type: one of node type constants, e.g. `MODEL`
+        :param name: resource name
+        :param created: creation time, epoch seconds
+        :param complete: node and its incoming edges will not change anymore
+        :param properties: extra attributes, e.g. status
+        :return: node id
+        """
+        nid = node_id(node_type, name)
+        self.connection.execute(
+            """
+            INSERT INTO nodes (id, type, name, created, complete, properties) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                name = excluded.name,
+                created = COALESCE(excluded.created, created),
+                complete = excluded.complete,
+                properties = COALESCE(excluded.properties, properties)
+            """,
+            (
+                nid,
+                node_type,
+                name,
+                created,
+                int(complete),
+                json.dumps(properties, default=str) if properties is not None else None,
+            ),
+        )
+        return nid
+
+    def add_edge(self, src: str, dst: str) -> None:
+        """
+        Add edge between node ids, missing nodes are created as incomplete placeholders
+        :param src: upstream node id
+        :param dst: downstream node id
+        """
+        for nid in (src, dst):
+            node_type, name = nid.split(":", 1)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO nodes (id, type, name) VALUES (?, ?, ?)",
+                (nid, node_type, name),
+            )
+        self.connection.execute(
+            "INSERT OR IGNORE INTO edges (src, dst) VALUES (?, ?)", (src, dst)
+        )
+
+    def remove_incoming_edges(self, nid: str) -> None:
+        """
+        Drop upstream edges of a node before re-adding them for mutable resources (e.g. endpoints)
+        :param nid: node id
+        """
+        self.connection.execute("DELETE FROM edges WHERE dst = ?", (nid,))
+
+    def commit(self) -> None:
+        """Commit pending changes"""
+        self.connection.commit()
+
+    def complete_ids(self, node_type: str) -> Set[str]:
+        """
+        :param node_type: one of node type constants
+        :return: ids of nodes which do not need to be fetched again
+        """
+        return {
+            row[0]
+            for row in self.connection.execute(
+                "SELECT id FROM nodes WHERE type = ? AND complete = 1", (node_type,)
+            )
+        }
+
+    def incomplete_ids(self, node_type: str) -> Set[str]:
+        """
+        :param node_type: one of node type constants
+        :return: ids of nodes which may still change, e.g. live endpoints
+        """
+        return {
+            row[0]
+            for row in self.connection.execute(
+                "SELECT id FROM nodes WHERE type = ? AND complete = 0", (node_type,)
+            )
+        }
+
+    def get_node(self, nid: str) -> Optional[LineageNode]:
+        """
+        :param nid: node id
+        :return: node or None if it is not in the graph
+        """
+        row = self.connection.execute(
+            "SELECT id, type, name, created, properties, 0 FROM nodes WHERE id = ?",
+            (nid,),
+        ).fetchone()
+        return _to_node(row) if row is not None else None
+
+    def upstream(
+        self,
+        nid: str,
+        node_type: Optional[str] = None,
+        max_depth: int = 100,
+    ) -> List[LineageNode]:
+        """
+        Nodes the given node was derived from
+        :param nid: node id
+        :param node_type: return only nodes of this type
+        :param max_depth: max number of hops
+        :return: nodes ordered by distance
+        """
+        return self._traverse(nid, "dst", "src", node_type, max_depth)
+
+    def downstream(
+        self,
+        nid: str,
+        node_type: Optional[str] = None,
+        max_depth: int = 100,
+    ) -> List[LineageNode]:
+        """
+        Nodes derived from the given node
+        :param nid: node id
+        :param node_type: return only nodes of this type
+        :param max_depth: max number of hops
+        :return: nodes ordered by distance
+        """
+        return self._traverse(nid, "src", "dst", node_type, max_depth)
+
+    def _traverse(
+        self,
+        nid: str,
+        this_column: str,
+        next_column: str,
+        node_type: Optional[str],
+        max_depth: int,
+    ) -> List[LineageNode]:
+        rows = self.connection.execute(
+            _TRAVERSAL_QUERY.format(this_column=this_column, next_column=next_column),
+            (nid, max_depth),
+        )
+        nodes = [_to_node(row) for row in rows]
+        return [n for n in nodes if node_type is None or n.type == node_type]
+
+
+class LineageCollector:  # pylint: disable=too-few-public-methods
+    """
+    Fetches Sagemaker resources concurrently into `LineageGraph`.
+    Refresh is incremental: finished executions and jobs, models, endpoint configs
+    and model packages already in the graph are not described again.
+
+    Example:
+    >>> graph = LineageGraph("lineage.db")
+    >>> LineageCollector(boto3.client("sagemaker"), graph).refresh(["a_cool_pipeline_name"])
+    >>> endpoint_lineage(graph, "my-endpoint")[PIPELINE_EXECUTION]
+    """
+
+    def __init__(
+        self, sagemaker_client: BaseClient, graph: LineageGraph, max_workers: int = 8
+    ):
+        """
+        :param sagemaker_client: An instance of `boto3.client("sagemaker")`.
+        :param graph: graph to populate
+        :param max_workers: number of concurrent describe calls
+        """
+        self.sagemaker_client = sagemaker_client
+        self.graph = graph
+        self.max_workers = max_workers
+
+    def refresh(
+        self, pipeline_names: Iterable[str] = (), include_endpoints: bool = True
+    ) -> None:
+        """
+        Fetch new and changed resources
+        :param pipeline_names: pipelines whose executions are added to the graph
+        :param include_endpoints: fetch endpoints with their configs, models and model packages
+        """
+        # resources referenced by executions and endpoints, by node type
+        targets: Dict[str, Set[str]] = {
+            node_type: set() for node_type in (*_JOB_DESCRIPTIONS, MODEL_PACKAGE, MODEL)
+        }
+        for pipeline_name in pipeline_names:
+            self._refresh_executions(pipeline_name, targets)
+        self._refresh_jobs(targets)
+        if include_endpoints:
+            targets[MODEL] |= self._refresh_endpoints()
+        targets[MODEL_PACKAGE] |= self._refresh_models(targets[MODEL])
+        self._refresh_model_packages(targets[MODEL_PACKAGE])
+        self.graph.commit()
+
+    def _map(self, func: Callable, items: Iterable) -> List:
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(func, items))
+
+    def _paginate(
+        self, operation: str, result_key: str, **kwargs
+    ) -> List[Dict[str, Any]]:
+        return [
+            item
+            for page in self.sagemaker_client.get_paginator(operation).paginate(
+                **kwargs
+            )
+            for item in page[result_key]
+        ]
+
+    def _describe(self, operation: str, **kwargs) -> Optional[Dict[str, Any]]:
+        """Resource description, None if the resource does not exist anymore"""
+        try:
+            return getattr(self.sagemaker_client, operation)(**kwargs)
+        except ClientError as error:
+            if helpers.is_not_found_error(error):
+                return None
+            raise
+
+    def _add_deleted(self, node_type: str, name: str) -> str:
+        """Deleted resources keep their edges but are never described again"""
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("%s %s does not exist anymore", node_type, name)
+        return self.graph.add_node(
+            node_type, name, complete=True, properties={"deleted": True}
+        )
+
+    def _new(self, node_type: str, names: Iterable[str]) -> List[str]:
+        complete = self.graph.complete_ids(node_type)
+        return sorted({n for n in names if node_id(node_type, n) not in complete})
+
+    def _refresh_executions(
+        self, pipeline_name: str, targets: Dict[str, Set[str]]
+    ) -> None:
+        summaries = self._paginate(
+            "list_pipeline_executions",
+            "PipelineExecutionSummaries",
+            PipelineName=pipeline_name,
+        )
+        complete = self.graph.complete_ids(PIPELINE_EXECUTION)
+        summaries = [
+            s
+            for s in summaries
+            if node_id(PIPELINE_EXECUTION, s["PipelineExecutionArn"]) not in complete
+        ]
+        steps = self._map(
+            lambda s: self._paginate(
+                "list_pipeline_execution_steps",
+                "PipelineExecutionSteps",
+                PipelineExecutionArn=s["PipelineExecutionArn"],
+            ),
+            summaries,
+        )
+        for summary, execution_steps in zip(summaries, steps):
+            execution_id = self.graph.add_node(
+                PIPELINE_EXECUTION,
+                summary["PipelineExecutionArn"],
+                _timestamp(summary.get("StartTime")),
+                summary["PipelineExecutionStatus"] in _TERMINAL_STATUSES,
+                {
+                    "pipeline": pipeline_name,
+                    "status": summary["PipelineExecutionStatus"],
+                },
+            )
+            for step in execution_steps:
+                for target_type, target_name in _step_targets(step.get("Metadata", {})):
+                    self.graph.add_edge(execution_id, node_id(target_type, target_name))
+                    targets[target_type].add(target_name)
+
+    def _refresh_jobs(self, targets: Dict[str, Set[str]]) -> None:
+        for job_type, (operation, name_arg) in _JOB_DESCRIPTIONS.items():
+            names = self._new(job_type, targets[job_type])
+            descriptions = self._map(
+                lambda name, op=operation, arg=name_arg: self._describe(
+                    op, **{arg: name}
+                ),
+                names,
+            )
+            for name, description in zip(names, descriptions):
+                if description is None:
+                    self._add_deleted(job_type, name)
+                    continue
+                inputs, outputs = _job_artifacts(job_type, description)
+                status = description.get(_JOB_STATUS_KEYS[job_type])
+                job_id = self.graph.add_node(
+                    job_type,
+                    name,
+                    _timestamp(description.get("CreationTime")),
+                    status in _TERMINAL_STATUSES,
+                    {"status": status},
+                )
+                for uri in inputs:
+                    self.graph.add_edge(node_id(ARTIFACT, uri), job_id)
+                for uri in outputs:
+                    self.graph.add_edge(job_id, node_id(ARTIFACT, uri))
+
+    def _refresh_endpoints(self) -> Set[str]:
+        endpoints = self._paginate("list_endpoints", "Endpoints")
+        descriptions = self._map(
+            lambda e: self._describe(
+                "describe_endpoint", EndpointName=e["EndpointName"]
+            ),
+            endpoints,
+        )
+        # endpoints deleted since the previous refresh are not listed anymore
+        listed = {node_id(ENDPOINT, e["EndpointName"]) for e in endpoints}
+        for nid in sorted(self.graph.incomplete_ids(ENDPOINT) - listed):
+            self.graph.remove_incoming_edges(
+                self._add_deleted(ENDPOINT, self.graph.get_node(nid).name)
+            )
+
+        config_names = set()
+        for endpoint, description in zip(endpoints, descriptions):
+            if description is None:
+                self.graph.remove_incoming_edges(
+                    self._add_deleted(ENDPOINT, endpoint["EndpointName"])
+                )
+                continue
+            endpoint_id = self.graph.add_node(
+                ENDPOINT,
+                description["EndpointName"],
+                _timestamp(description.get("CreationTime")),
+                properties={"status": description.get("EndpointStatus")},
+            )
+            # endpoints are updated in place, their config is re-read every refresh
+            self.graph.remove_incoming_edges(endpoint_id)
+            self.graph.add_edge(
+                node_id(ENDPOINT_CONFIG, description["EndpointConfigName"]), endpoint_id
+            )
+            config_names.add(description["EndpointConfigName"])
+
+        names = self._new(ENDPOINT_CONFIG, config_names)
+        config_descriptions = self._map(
+            lambda name: self._describe(
+                "describe_endpoint_config", EndpointConfigName=name
+            ),
+            names,
+        )
+        models = set()
+        for name, description in zip(names, config_descriptions):
+            if description is None:
+                self._add_deleted(ENDPOINT_CONFIG, name)
+                continue
+            config_id = self.graph.add_node(
+                ENDPOINT_CONFIG,
+                name,
+                _timestamp(description.get("CreationTime")),
+                complete=True,
+            )
+            for variant in description.get("ProductionVariants", []):
+                self.graph.add_edge(node_id(MODEL, variant["ModelName"]), config_id)
+                models.add(variant["ModelName"])
+        return models
+
+    def _refresh_models(self, models: Set[str]) -> Set[str]:
+        names = self._new(MODEL, models)
+        descriptions = self._map(
+            lambda name: self._describe("describe_model", ModelName=name), names
+        )
+        packages = set()
+        for name, description in zip(names, descriptions):
+            if description is None:
+                self._add_deleted(MODEL, name)
+                continue
+            model_id = self.graph.add_node(
+                MODEL, name, _timestamp(description.get("CreationTime")), complete=True
+            )
+            containers = description.get("Containers", [])
+            if "PrimaryContainer" in description:
+                containers = containers + [description["PrimaryContainer"]]
+            for container in containers:
+                if "ModelPackageName" in container:
+                    self.graph.add_edge(
+                        node_id(MODEL_PACKAGE, container["ModelPackageName"]), model_id
+                    )
+                    packages.add(container["ModelPackageName"])
+                if "ModelDataUrl" in container:
+                    self.graph.add_edge(
+                        node_id(ARTIFACT, container["ModelDataUrl"]), model_id
+                    )
+        return packages
+
+    def _refresh_model_packages(self, packages: Set[str]) -> None:
+        names = self._new(MODEL_PACKAGE, packages)
+        descriptions = self._map(
+            lambda name: self._describe(
+                "describe_model_package", ModelPackageName=name
+            ),
+            names,
+        )
+        for name, description in zip(names, descriptions):
+            if description is None:
+                self._add_deleted(MODEL_PACKAGE, name)
+                continue
+            package_id = self.graph.add_node(
+                MODEL_PACKAGE,
+                name,
+                _timestamp(description.get("CreationTime")),
+                complete=True,
+                properties={
+                    "group": description.get("ModelPackageGroupName"),
+                    "approval": description.get("ModelApprovalStatus"),
+                },
+            )
+            containers = description.get("InferenceSpecification", {}).get(
+                "Containers", []
+            )
+            for container in containers:
+                if "ModelDataUrl" in container:
+                    self.graph.add_edge(
+                        node_id(ARTIFACT, container["ModelDataUrl"]), package_id
+                    )
+
+
+def endpoint_lineage(
+    graph: LineageGraph, endpoint_name: str
+) -> Dict[str, List[LineageNode]]:
+    """
+    Everything the endpoint was derived from, grouped by node type.
+    Datasets are the upstream artifacts which were not produced by any job.
+    :param graph: lineage graph
+    :param endpoint_name: endpoint name
+    :return: node type -> upstream nodes, plus "dataset" key
+    """
+    nodes = graph.upstream(node_id(ENDPOINT, endpoint_name))
+    result: Dict[str, List[LineageNode]] = {}
+    for node in nodes:
+        result.setdefault(node.type, []).append(node)
+    result["dataset"] = [
+        node
+        for node in result.get(ARTIFACT, [])
+        if not any(
+            n.type in _JOB_DESCRIPTIONS for n in graph.upstream(node.id, max_depth=1)
+        )
+    ]
+    return result
+
+
+def _step_targets(metadata: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """Resources created by a pipeline step"""
+    targets = []
+    for key, node_type in _STEP_METADATA_TYPES.items():
+        arn = metadata.get(key, {}).get("Arn")
+        if arn is None:
+            continue
+        # model packages are referenced by ARN, other resources by name
+        targets.append(
+            (
+                node_type,
+                arn if node_type == MODEL_PACKAGE else helpers.get_job_name(arn),
+            )
+        )
+    return targets
+
+
+def _job_artifacts(
+    job_type: str, description: Dict[str, Any]
+) -> Tuple[List[str], List[str]]:
+    """S3 inputs and outputs of a job"""
+    if job_type == PROCESSING_JOB:
+        inputs = [
+            i["S3Input"]["S3Uri"]
+            for i in description.get("ProcessingInputs", [])
+            if "S3Input" in i
+        ]
+        outputs = [
+            o["S3Output"]["S3Uri"]
+            for o in description.get("ProcessingOutputConfig", {}).get("Outputs", [])
+            if "S3Output" in o
+        ]
+    elif job_type == TRAINING_JOB:
+        inputs = [
+            c["DataSource"]["S3DataSource"]["S3Uri"]
+            for c in description.get("InputDataConfig", [])
+            if "S3DataSource" in c.get("DataSource", {})
+        ]
+        model_artifacts = description.get("ModelArtifacts", {}).get("S3ModelArtifacts")
+        outputs = [model_artifacts] if model_artifacts else []
+    else:
+        inputs = (
+            [description["TransformInput"]["DataSource"]["S3DataSource"]["S3Uri"]]
+            if "TransformInput" in description
+            else []
+        )
+        outputs = (
+            [description["TransformOutput"]["S3OutputPath"]]
+            if "TransformOutput" in description
+            else []
+        )
+    return inputs, outputs
+
+
+def _to_node(row: Tuple) -> LineageNode:
+    nid, node_type, name, created, properties, depth = row
+    return LineageNode(
+        id=nid,
+        type=node_type,
+        name=name,
+        created=created,
+        properties=json.loads(properties) if properties else {},
+        depth=depth,
+    )
+
+
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    return value.timestamp() if value is not None else None
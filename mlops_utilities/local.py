@@ -0,0 +1,462 @@
+"""Local execution of Sagemaker pipeline definitions"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import boto3  # type: ignore
+from botocore.client import BaseClient  # type: ignore
+
+from mlops_utilities import helpers
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_DIR = os.environ.get("MLOPS_LOCAL_DIR", ".mlops_local")
+DEFINITION_FILE_NAME = "definition.json"
+SUCCESS_FILE_NAME = "_SUCCESS"
+
+STATUS_SUCCEEDED = "Succeeded"
+STATUS_CACHED = "Cached"
+STATUS_SKIPPED = "Skipped"
+
+_PROCESSING_OUTPUT_PATTERN = re.compile(
+    r"^Steps\.[^.]+\.ProcessingOutputConfig\.Outputs\['([^']+)'\]\.S3Output\.S3Uri$"
+)
+_PYTHON_COMMANDS = {"python", "python3"}
+
+
+@dataclass
+class LocalStepResult:
+    """Outcome of a single locally executed pipeline step"""
+
+    name: str
+    status: str
+    cache_key: Optional[str] = None
+    step_dir: Optional[str] = None
+    outputs: Dict[str, str] = field(default_factory=dict)
+
+
+def get_pipeline_dir(pipeline_name: str, local_dir: Optional[str] = None) -> Path:
+    """
+    Directory which keeps local pipeline definition and cached step outputs
+    :param pipeline_name: the name of the pipeline
+    :param local_dir: root directory for local pipelines, `DEFAULT_LOCAL_DIR` if not set
+    :return: pipeline directory path
+    """
+    return Path(local_dir or DEFAULT_LOCAL_DIR) / pipeline_name
+
+
+def save_pipeline_definition(
+    pipeline_name: str, definition: str, local_dir: Optional[str] = None
+) -> Path:
+    """
+    Store pipeline definition so that it can be executed locally later on
+    :param pipeline_name: the name of the pipeline
+    :param definition: pipeline definition JSON as returned by `Pipeline.definition()`
+    :param local_dir: root directory for local pipelines, `DEFAULT_LOCAL_DIR` if not set
+    :return: path of the stored definition
+    """
+    pipeline_dir = get_pipeline_dir(pipeline_name, local_dir)
+    pipeline_dir.mkdir(parents=True, exist_ok=True)
+    definition_path = pipeline_dir / DEFINITION_FILE_NAME
+    definition_path.write_text(definition)
+    return definition_path
+
+
+def load_pipeline_definition(
+    pipeline_name: str, local_dir: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Load pipeline definition stored by `save_pipeline_definition`
+    :param pipeline_name: the name of the pipeline
+    :param local_dir: root directory for local pipelines, `DEFAULT_LOCAL_DIR` if not set
+    :return: pipeline definition
+    :raises ValueError: if the pipeline was not upserted locally
+    """
+    definition_path = get_pipeline_dir(pipeline_name, local_dir) / DEFINITION_FILE_NAME
+    if not definition_path.exists():
+        raise ValueError(
+            f"Local pipeline {pipeline_name} not found, run upsert_pipeline(..., local_mode=True) first"
+        )
+    return json.loads(definition_path.read_text())
+
+
+class LocalPipelineRunner:
+    """
+    Executes processing and training steps of a pipeline definition as local subprocesses.
+
+    Steps run in dependency order, independent steps run in parallel.
+    Step outputs are kept on disk under a key derived from resolved step arguments,
+    so a step whose inputs did not change is not executed again.
+    Script-mode steps are expected to take their input/output locations from
+    container arguments (processing) or SM_* environment variables (training).
+    """
+
+    def __init__(
+        self,
+        definition: Dict[str, Any],
+        work_dir: Path,
+        max_workers: Optional[int] = None,
+        s3_client: Optional[BaseClient] = None,
+    ):
+        """
+        :param definition: pipeline definition (parsed `Pipeline.definition()` JSON)
+        :param work_dir: directory where step outputs are cached
+        :param max_workers: max number of steps executed concurrently
+        :param s3_client: boto3 S3 client, used only for steps with S3 inputs
+        :raises ValueError: if a training step has no training script (built-in algorithm)
+        """
+        self.definition = definition
+        # steps run with their own working directory, so every path passed to them must be absolute
+        self.work_dir = Path(work_dir).resolve()
+        self.max_workers = max_workers
+        self._s3_client = s3_client
+        self._steps = {step["Name"]: step for step in definition.get("Steps", [])}
+        self._dependencies = helpers.get_step_dependencies(definition)
+        for name, step in self._steps.items():
+            # built-in algorithms run their own container code, there is nothing to run locally
+            if step["Type"] == "Training" and not {
+                "sagemaker_submit_directory",
+                "sagemaker_program",
+            } <= set(step["Arguments"].get("HyperParameters", {})):
+                raise ValueError(
+                    f"Training step {name} has no training script (sagemaker_program), "
+                    "built-in algorithms can't run in local mode"
+                )
+
+    @property
+    def s3_client(self) -> BaseClient:
+        """Lazily created S3 client"""
+        if self._s3_client is None:
+            self._s3_client = boto3.client("s3")
+        return self._s3_client
+
+    def run(
+        self, pipeline_params: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, LocalStepResult]:
+        """
+        Execute pipeline steps
+        :param pipeline_params: values of pipeline parameters overriding defaults
+        :return: step name -> step result
+        :raises RuntimeError: if a step fails
+        """
+        params = {
+            p["Name"]: p.get("DefaultValue")
+            for p in self.definition.get("Parameters", [])
+        }
+        params.update(pipeline_params or {})
+
+        results: Dict[str, LocalStepResult] = {}
+        pending = set(self._steps)
+        running: Dict[Future, str] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for name in sorted(self._ready_steps(pending, results)):
+                    pending.remove(name)
+                    running[
+                        executor.submit(self._run_step, name, params, results)
+                    ] = name
+                if not running:
+                    raise ValueError(
+                        f"Unresolvable step dependencies: {sorted(pending)}"
+                    )
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+        return results
+
+    def _ready_steps(
+        self, pending: Set[str], results: Dict[str, LocalStepResult]
+    ) -> List[str]:
+        return [
+            name
+            for name in pending
+            if all(dep in results for dep in self._dependencies[name])
+        ]
+
+    def _run_step(
+        self,
+        name: str,
+        params: Dict[str, Any],
+        results: Dict[str, LocalStepResult],
+    ) -> LocalStepResult:
+        step = self._steps[name]
+        if step["Type"] not in ("Processing", "Training"):
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Skip %s step %s in local mode", step["Type"], name)
+            return LocalStepResult(name=name, status=STATUS_SKIPPED)
+
+        arguments = _resolve(step["Arguments"], params, results)
+        cache_key = self._get_cache_key(step["Type"], arguments)
+        step_dir = self.work_dir / name / cache_key
+        if (step_dir / SUCCESS_FILE_NAME).exists():
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Step %s is cached in %s", name, step_dir)
+            return LocalStepResult(
+                name=name,
+                status=STATUS_CACHED,
+                cache_key=cache_key,
+                step_dir=str(step_dir),
+                outputs=json.loads((step_dir / SUCCESS_FILE_NAME).read_text()),
+            )
+
+        if step_dir.exists():
+            shutil.rmtree(step_dir)
+        step_dir.mkdir(parents=True)
+        if step["Type"] == "Processing":
+            command, env, cwd, outputs = self._prepare_processing(arguments, step_dir)
+        else:
+            command, env, cwd, outputs = self._prepare_training(arguments, step_dir)
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Run step %s: %s", name, " ".join(command))
+        with open(step_dir / "output.log", "wb") as log_file:
+            completed = subprocess.run(
+                command,
+                env=env,
+                cwd=cwd,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                check=False,
+            )
+        if completed.returncode != 0:
+            raise RuntimeError(
+                f"Step {name} failed with exit code {completed.returncode}, see {step_dir / 'output.log'}"
+            )
+        (step_dir / SUCCESS_FILE_NAME).write_text(json.dumps(outputs))
+        return LocalStepResult(
+            name=name,
+            status=STATUS_SUCCEEDED,
+            cache_key=cache_key,
+            step_dir=str(step_dir),
+            outputs=outputs,
+        )
+
+    def _get_cache_key(self, step_type: str, arguments: Dict[str, Any]) -> str:
+        digest = hashlib.sha256(step_type.encode("utf-8"))
+        digest.update(
+            json.dumps(arguments, sort_keys=True, default=str).encode("utf-8")
+        )
+        # outputs of upstream steps are already identified by their cache keys,
+        # hyperparameters are JSON encoded hence quotes are stripped
+        for uri in sorted({v.strip('"') for v in _iter_strings(arguments)}):
+            if uri.startswith("file://") and not uri.startswith(
+                f"file://{self.work_dir}"
+            ):
+                digest.update(_hash_path(Path(uri[len("file://") :])).encode("utf-8"))
+        # new data under the same S3 URI has to invalidate the cache as well
+        for uri in sorted(_iter_input_uris(arguments)):
+            if uri.startswith("s3://"):
+                digest.update(self._hash_s3_prefix(uri).encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def _hash_s3_prefix(self, uri: str) -> str:
+        """Hash of keys, sizes and ETags of S3 objects under the URI"""
+        bucket, prefix = helpers.split_s3_uri(uri)
+        digest = hashlib.sha256()
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                digest.update(
+                    f"{obj['Key']}\t{obj['Size']}\t{obj['ETag']}\n".encode("utf-8")
+                )
+        return digest.hexdigest()
+
+    def _prepare_processing(self, arguments: Dict[str, Any], step_dir: Path):
+        path_mapping = {}
+        for processing_input in arguments.get("ProcessingInputs", []):
+            s3_input = processing_input["S3Input"]
+            path_mapping[s3_input["LocalPath"]] = self._fetch(
+                s3_input["S3Uri"], step_dir / "inputs" / processing_input["InputName"]
+            )
+        outputs = {}
+        output_config = arguments.get("ProcessingOutputConfig", {"Outputs": []})
+        for output in output_config["Outputs"]:
+            output_dir = step_dir / "outputs" / output["OutputName"]
+            output_dir.mkdir(parents=True)
+            path_mapping[output["S3Output"]["LocalPath"]] = str(output_dir)
+            outputs[output["OutputName"]] = str(output_dir)
+
+        app_spec = arguments["AppSpecification"]
+        command = [
+            _map_container_path(part, path_mapping)
+            for part in app_spec.get("ContainerEntrypoint", [])
+            + app_spec.get("ContainerArguments", [])
+        ]
+        if command and command[0] in _PYTHON_COMMANDS:
+            command[0] = sys.executable
+        env = dict(os.environ, **arguments.get("Environment", {}))
+        return command, env, str(step_dir), outputs
+
+    def _prepare_training(self, arguments: Dict[str, Any], step_dir: Path):
+        hyperparameters = {
+            k: _load_hyperparameter(v)
+            for k, v in arguments.get("HyperParameters", {}).items()
+        }
+        source_dir = self._fetch_source_dir(
+            hyperparameters.pop("sagemaker_submit_directory"), step_dir / "code"
+        )
+        program = hyperparameters.pop("sagemaker_program")
+        user_hyperparameters = {
+            k: v for k, v in hyperparameters.items() if not k.startswith("sagemaker_")
+        }
+
+        model_dir = step_dir / "model"
+        model_dir.mkdir(parents=True)
+        (step_dir / "output" / "data").mkdir(parents=True)
+        channels = {
+            channel["ChannelName"]: self._fetch(
+                channel["DataSource"]["S3DataSource"]["S3Uri"],
+                step_dir / "input" / channel["ChannelName"],
+            )
+            for channel in arguments.get("InputDataConfig", [])
+        }
+        env = {
+            **os.environ,
+            **arguments.get("Environment", {}),
+            **{f"SM_CHANNEL_{name.upper()}": path for name, path in channels.items()},
+            "SM_MODEL_DIR": str(model_dir),
+            "SM_OUTPUT_DATA_DIR": str(step_dir / "output" / "data"),
+            "SM_CHANNELS": json.dumps(list(channels)),
+            "SM_HPS": json.dumps(user_hyperparameters),
+        }
+        command = [sys.executable, program]
+        for key, value in user_hyperparameters.items():
+            command += [
+                f"--{key}",
+                value if isinstance(value, str) else json.dumps(value),
+            ]
+        return command, env, source_dir, {"model": str(model_dir)}
+
+    def _fetch_source_dir(self, submit_directory: str, destination: Path) -> str:
+        if submit_directory.startswith("s3://"):
+            bucket, key = helpers.split_s3_uri(submit_directory)
+            source = destination / "sourcedir.tar.gz"
+            source.parent.mkdir(parents=True, exist_ok=True)
+            self.s3_client.download_file(bucket, key, str(source))
+        else:
+            source = Path(submit_directory.replace("file://", "", 1)).resolve()
+        if source.is_dir():
+            return str(source)
+        with tarfile.open(source) as archive:
+            archive.extractall(destination / "source")
+        return str(destination / "source")
+
+    def _fetch(self, uri: str, destination: Path) -> str:
+        """
+        Local directory with the given input data,
+        S3 objects are downloaded into `destination` the same way Sagemaker does it for jobs
+        """
+        if not uri.startswith("s3://"):
+            path = Path(uri.replace("file://", "", 1)).resolve()
+            return str(path.parent if path.is_file() else path)
+        bucket, prefix = helpers.split_s3_uri(uri)
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                target = destination / (
+                    Path(key).name if key == prefix else os.path.relpath(key, prefix)
+                )
+                target.parent.mkdir(parents=True, exist_ok=True)
+                self.s3_client.download_file(bucket, key, str(target))
+        destination.mkdir(parents=True, exist_ok=True)
+        return str(destination)
+
+
+def _resolve(value: Any, params: Dict[str, Any], results: Dict[str, LocalStepResult]):
+    """Substitute pipeline parameters and step properties with their local values"""
+    if isinstance(value, list):
+        return [_resolve(v, params, results) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if set(value) == {"Get"}:
+        return _resolve_ref(value["Get"], params, results)
+    if set(value) == {"Std:Join"}:
+        join = value["Std:Join"]
+        return join["On"].join(
+            str(_resolve(v, params, results)) for v in join["Values"]
+        )
+    return {k: _resolve(v, params, results) for k, v in value.items()}
+
+
+def _resolve_ref(ref: str, params: Dict[str, Any], results: Dict[str, LocalStepResult]):
+    if ref.startswith("Parameters."):
+        return params[ref[len("Parameters.") :]]
+    if ref.startswith("Execution."):
+        return ref
+    step_name = helpers.STEP_REF_PATTERN.match(ref).group(1)
+    step_result = results[step_name]
+    match = _PROCESSING_OUTPUT_PATTERN.match(ref)
+    if match:
+        return f"file://{step_result.outputs[match.group(1)]}"
+    if ref.endswith(".ModelArtifacts.S3ModelArtifacts"):
+        return f"file://{step_result.outputs['model']}"
+    raise ValueError(f"Property {ref} is not supported in local mode")
+
+
+def _iter_input_uris(arguments: Dict[str, Any]):
+    """Data and code locations a processing or training step reads"""
+    for processing_input in arguments.get("ProcessingInputs", []):
+        yield processing_input["S3Input"]["S3Uri"]
+    for channel in arguments.get("InputDataConfig", []):
+        yield channel["DataSource"]["S3DataSource"]["S3Uri"]
+    submit_directory = arguments.get("HyperParameters", {}).get(
+        "sagemaker_submit_directory"
+    )
+    if submit_directory is not None:
+        yield submit_directory.strip('"')
+
+
+def _iter_strings(value: Any):
+    if isinstance(value, list):
+        for item in value:
+            yield from _iter_strings(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _iter_strings(item)
+    elif isinstance(value, str):
+        yield value
+
+
+def _map_container_path(value: str, path_mapping: Dict[str, str]) -> str:
+    for container_path in sorted(path_mapping, key=len, reverse=True):
+        if value.startswith(container_path):
+            return path_mapping[container_path] + value[len(container_path) :]
+    return value
+
+
+def _load_hyperparameter(value: str) -> Any:
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _hash_path(path: Path) -> str:
+    """Content hash of a local file or directory"""
+    digest = hashlib.sha256()
+    files = (
+        sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    )
+    for file_path in files:
+        if not file_path.exists():
+            continue
+        digest.update(
+            str(file_path.relative_to(path) if path.is_dir() else "").encode()
+        )
+        with open(file_path, "rb") as file:
+            for chunk in iter(partial(file.read, 1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,371 @@
+"""Building of Sagemaker pipelines from Jupyter notebooks"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from botocore.client import BaseClient  # type: ignore
+from omegaconf import OmegaConf
+from omegaconf.dictconfig import DictConfig
+from sagemaker.processing import ProcessingInput, ProcessingOutput  # type: ignore
+from sagemaker.sklearn.processing import SKLearnProcessor  # type: ignore
+from sagemaker.workflow.parameters import ParameterString  # type: ignore
+from sagemaker.workflow.pipeline import Pipeline  # type: ignore
+from sagemaker.workflow.pipeline_context import PipelineSession  # type: ignore
+from sagemaker.workflow.steps import ProcessingStep  # type: ignore
+
+from mlops_utilities import transfer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get("MLOPS_NOTEBOOK_CACHE_DIR", ".mlops_notebooks")
+UPLOADED_FILE_NAME = "uploaded"
+PARAMETERS_TAG = "parameters"
+INPUT_DIR = "/opt/ml/processing/input/data"
+OUTPUT_DIR = "/opt/ml/processing/output"
+
+# bump when the generated script changes so that cached conversions are invalidated
+_CONVERTER_VERSION = "3"
+_MAGIC_PREFIXES = ("%", "!")
+_CELL_MAGIC_PREFIX = "%%"
+_PARAMETERS_CODE = """# parameters passed as "--<name> <value>" container arguments,
+# values are parsed as python literals unless the notebook default is a string
+import ast as _ast
+import sys as _sys
+
+for _name, _value in zip(_sys.argv[1::2], _sys.argv[2::2]):
+    _name = _name.lstrip("-")
+    _default = globals().get(_name)
+    if not isinstance(_default, str):
+        try:
+            _value = _ast.literal_eval(_value)
+        except (ValueError, SyntaxError):
+            pass
+        if isinstance(_default, float) and type(_value) is int:
+            _value = float(_value)
+    globals()[_name] = _value
+"""
+_PIPELINE_MODULE = '''"""Pipeline generated by mlops_utilities.notebooks, steps are listed in {config_name}.yml"""
+from mlops_utilities.notebooks import get_notebook_pipeline as get_pipeline
+
+__all__ = ["get_pipeline"]
+'''
+_DEFAULT_CONF = {
+    "pipeline": {"input_data_s3_uri": None},
+    "processing": {
+        "framework_version": "1.2-1",
+        "instance_type": "ml.m5.large",
+        "instance_count": 1,
+    },
+}
+
+
+@dataclass
+class NotebookPackage:
+    """
+    Step script converted from a notebook
+
+    :param notebook: notebook path
+    :param name: pipeline step name
+    :param digest: hash of the notebook code cells, scripts are cached by it
+    :param script: local path of the converted script
+    :param code: S3 URI of the uploaded script, `script` if it is not uploaded
+    :param converted: False if the script was taken from the cache
+    :param uploaded: False if the script was not uploaded by this call
+    """
+
+    notebook: str
+    name: str
+    digest: str
+    script: str
+    code: str
+    converted: bool
+    uploaded: bool
+
+
+def notebook_digest(notebook: Dict[str, Any]) -> str:
+    """
+    Hash of notebook code cells, outputs and metadata other than cell tags do not affect it
+    :param notebook: parsed notebook JSON
+    :return: hex digest
+    """
+    digest = hashlib.sha256(_CONVERTER_VERSION.encode("utf-8"))
+    for cell in _code_cells(notebook):
+        digest.update(
+            json.dumps(
+                [_cell_source(cell), _is_parameters_cell(cell)], ensure_ascii=False
+            ).encode("utf-8")
+        )
+    return digest.hexdigest()
+
+
+def notebook_to_script(notebook: Dict[str, Any], title: str = "notebook") -> str:
+    """
+    Convert notebook code cells into a python script.
+    IPython magics and shell commands are commented out (whole cells for `%%` cell magics,
+    `pass` is left in indented blocks). Container arguments override variables
+    of the cell tagged `parameters` (same convention as papermill) keeping the type of their defaults,
+    `input_dir` and `output_dir` are always passed by the generated pipeline.
+    :param notebook: parsed notebook JSON
+    :param title: notebook name put into the script header
+    :return: script source
+    """
+    cells = _code_cells(notebook)
+    parameters_index = next(
+        (i for i, cell in enumerate(cells) if _is_parameters_cell(cell)), -1
+    )
+    parts = [f"# Generated from {title} by mlops_utilities.notebooks\n"]
+    if parameters_index < 0:
+        parts.append(_PARAMETERS_CODE)
+    for i, cell in enumerate(cells):
+        parts.append(_convert_cell(_cell_source(cell)).rstrip("\n") + "\n")
+        if i == parameters_index:
+            parts.append(_PARAMETERS_CODE)
+    return "\n\n".join(parts)
+
+
+def _convert_cell(source: str) -> str:
+    """Cell source with IPython magics and shell commands commented out"""
+    lines = source.splitlines(keepends=True)
+    if lines and lines[0].lstrip().startswith(_CELL_MAGIC_PREFIX):
+        # the whole cell is the magic's input, e.g. %%bash or %%writefile
+        return "".join(f"# {line}" for line in lines)
+    converted = []
+    for line in lines:
+        code = line.lstrip()
+        if not code.startswith(_MAGIC_PREFIXES):
+            converted.append(line)
+            continue
+        indent = line[: len(line) - len(code)]
+        # a commented out line can leave an indented block empty
+        converted.append(f"{indent}pass  # {code}" if indent else f"# {code}")
+    return "".join(converted)
+
+
+class NotebookPackager:
+    """
+    Converts notebooks into step scripts and uploads them to S3.
+    Scripts are cached under `cache_dir/<notebook digest>` and uploaded to `code_s3_prefix/<notebook digest>`,
+    so unchanged notebooks are neither converted nor uploaded again.
+
+    Example:
+    >>> packager = NotebookPackager(boto3.client("s3"), "s3://bucket/code")
+    >>> packages = packager.package_all(["preprocess.ipynb", "train.ipynb"])
+    """
+
+    def __init__(
+        self,
+        s3_client: Optional[BaseClient] = None,
+        code_s3_prefix: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        max_workers: int = 8,
+    ):
+        """
+        :param s3_client: An instance of `boto3.client("s3")`, required if `code_s3_prefix` is set
+        :param code_s3_prefix: S3 prefix for the scripts, scripts are not uploaded if not set
+        :param cache_dir: directory of converted scripts, `DEFAULT_CACHE_DIR` if not set
+        :param max_workers: number of notebooks packaged concurrently
+        """
+        if code_s3_prefix is not None and s3_client is None:
+            raise ValueError("s3_client is required to upload scripts")
+        self.s3_client = s3_client
+        self.code_s3_prefix = code_s3_prefix.rstrip("/") if code_s3_prefix else None
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_workers = max_workers
+
+    def package(self, notebook_path: str) -> NotebookPackage:
+        """
+        Convert (and upload) a single notebook
+        :param notebook_path: path of the .ipynb file
+        :return: converted script
+        """
+        with open(notebook_path, encoding="utf-8") as file:
+            notebook = json.load(file)
+        stem = Path(notebook_path).stem
+        digest = notebook_digest(notebook)
+        script = self.cache_dir / digest / f"{re.sub(r'[^0-9A-Za-z_]', '_', stem)}.py"
+
+        converted = not script.is_file()
+        if converted:
+            script.parent.mkdir(parents=True, exist_ok=True)
+            tmp_script = script.with_name(
+                f".{script.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            tmp_script.write_text(
+                notebook_to_script(notebook, Path(notebook_path).name),
+                encoding="utf-8",
+            )
+            os.replace(tmp_script, script)
+        elif logger.isEnabledFor(logging.INFO):
+            logger.info("Notebook %s is unchanged, using %s", notebook_path, script)
+
+        # absolute path keeps the generated config valid regardless of the working directory
+        script = script.absolute()
+        code, uploaded = str(script), False
+        if self.code_s3_prefix is not None:
+            code = f"{self.code_s3_prefix}/{digest}/{script.name}"
+            uploaded = self._upload(script, code)
+        return NotebookPackage(
+            notebook=notebook_path,
+            name=re.sub(r"[^0-9A-Za-z\-]", "-", stem),
+            digest=digest,
+            script=str(script),
+            code=code,
+            converted=converted,
+            uploaded=uploaded,
+        )
+
+    def package_all(self, notebook_paths: Sequence[str]) -> List[NotebookPackage]:
+        """
+        Convert (and upload) notebooks concurrently
+        :param notebook_paths: paths of the .ipynb files
+        :return: converted scripts in the order of `notebook_paths`
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.package, notebook_paths))
+
+    def _upload(self, script: Path, s3_uri: str) -> bool:
+        uploaded_file = script.parent / UPLOADED_FILE_NAME
+        if uploaded_file.is_file() and s3_uri in uploaded_file.read_text(
+            encoding="utf-8"
+        ).split("\n"):
+            return False
+        uploaded = transfer.upload_file(self.s3_client, str(script), s3_uri)
+        with open(uploaded_file, "a", encoding="utf-8") as file:
+            file.write(f"{s3_uri}\n")
+        return uploaded
+
+
+def build_pipeline_package(
+    notebook_paths: Sequence[str],
+    output_dir: str,
+    module_name: str = "pipeline",
+    config_type: str = "defaults",
+    packager: Optional[NotebookPackager] = None,
+    conf: Optional[Dict[str, Any]] = None,
+) -> List[NotebookPackage]:
+    """
+    Package notebooks and generate a pipeline package consumable by `upsert_pipeline`:
+        output_dir
+        |-- __init__.py
+        |-- <module_name>.py
+        `-- <module_name>.<config_type>.yml
+
+    Every notebook becomes a processing step, steps are chained in the order of `notebook_paths`.
+    Files are rewritten only if their content changes.
+
+    Example:
+    >>> build_pipeline_package(["my_project07.ipynb"], "notebook_pipeline")
+    >>> upsert_pipeline("notebook_pipeline", "pipeline", "my-pipeline", "pipeline.defaults", "role-arn")
+
+    :param notebook_paths: paths of the .ipynb files
+    :param output_dir: directory of the generated package, its name must be a valid python identifier
+    :param module_name: name of the generated pipeline module
+    :param config_type: name of the generated config, <module_name>.<config_type>.yml
+    :param packager: notebook packager, `NotebookPackager()` (local scripts, no upload) if not set
+    :param conf: config overrides, e.g. {"processing": {"instance_type": "ml.m5.xlarge"}}
+    :return: converted scripts
+    """
+    packages = (packager or NotebookPackager()).package_all(notebook_paths)
+    config_name = f"{module_name}.{config_type}"
+    result_conf = OmegaConf.merge(
+        _DEFAULT_CONF,
+        {"steps": [{"name": p.name, "code": p.code} for p in packages]},
+        conf or {},
+    )
+
+    package_dir = Path(output_dir)
+    package_dir.mkdir(parents=True, exist_ok=True)
+    _write_if_changed(package_dir / "__init__.py", "")
+    _write_if_changed(
+        package_dir / f"{module_name}.py",
+        _PIPELINE_MODULE.format(config_name=config_name),
+    )
+    _write_if_changed(
+        package_dir / f"{config_name}.yml", OmegaConf.to_yaml(result_conf)
+    )
+    return packages
+
+
+def get_notebook_pipeline(
+    sm_session: PipelineSession, pipeline_name: str, conf: DictConfig
+) -> Pipeline:
+    """
+    Pipeline of processing steps running converted notebooks with scikit-learn processor.
+    The first step reads `InputDataS3Uri` pipeline parameter, every next step reads the output of the previous one.
+    :param sm_session: pipeline session
+    :param pipeline_name: the name of the pipeline
+    :param conf: config generated by `build_pipeline_package`
+    :return: pipeline
+    """
+    input_data = ParameterString(
+        name="InputDataS3Uri", default_value=conf.pipeline.input_data_s3_uri
+    )
+    steps: List[ProcessingStep] = []
+    source: Any = input_data
+    for step_conf in conf.steps:
+        processing_conf = OmegaConf.merge(
+            conf.processing, step_conf.get("processing", {})
+        )
+        processor = SKLearnProcessor(
+            framework_version=processing_conf.framework_version,
+            instance_type=processing_conf.instance_type,
+            instance_count=processing_conf.instance_count,
+            role=conf.pipeline.role,
+            base_job_name=step_conf.name,
+            sagemaker_session=sm_session,
+        )
+        arguments = ["--input_dir", INPUT_DIR, "--output_dir", OUTPUT_DIR]
+        for name, value in step_conf.get("parameters", {}).items():
+            arguments += [f"--{name}", str(value)]
+        step = ProcessingStep(
+            name=step_conf.name,
+            step_args=processor.run(
+                code=step_conf.code,
+                inputs=[
+                    ProcessingInput(
+                        source=source, destination=INPUT_DIR, input_name="data"
+                    )
+                ],
+                outputs=[ProcessingOutput(source=OUTPUT_DIR, output_name="output")],
+                arguments=arguments,
+            ),
+        )
+        steps.append(step)
+        # step properties are built from the DescribeProcessingJob response shape at runtime
+        source = (
+            step.properties.ProcessingOutputConfig.Outputs[  # pylint: disable=no-member
+                "output"
+            ].S3Output.S3Uri
+        )
+    return Pipeline(
+        name=pipeline_name,
+        parameters=[input_data],
+        steps=steps,
+        sagemaker_session=sm_session,
+    )
+
+
+def _code_cells(notebook: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [cell for cell in notebook.get("cells", []) if cell["cell_type"] == "code"]
+
+
+def _cell_source(cell: Dict[str, Any]) -> str:
+    source = cell.get("source", "")
+    return "".join(source) if isinstance(source, list) else source
+
+
+def _is_parameters_cell(cell: Dict[str, Any]) -> bool:
+    return PARAMETERS_TAG in cell.get("metadata", {}).get("tags", [])
+
+
+def _write_if_changed(path: Path, content: str) -> None:
+    if path.is_file() and path.read_text(encoding="utf-8") == content:
+        return
+    path.write_text(content, encoding="utf-8")
@@ -0,0 +1,446 @@
+"""Performance profiling of Sagemaker pipeline executions"""
+import csv
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import quote
+
+import numpy as np
+from botocore.client import BaseClient  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
+
+from mlops_utilities import helpers
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get("MLOPS_PROFILER_CACHE_DIR", ".mlops_profiler")
+TERMINAL_STATUSES = ("Succeeded", "Failed", "Stopped")
+
+# job start/end attributes used to split step time into queueing and running
+_JOB_DESCRIPTIONS = {
+    "TrainingJob": (
+        "describe_training_job",
+        "TrainingJobName",
+        "TrainingStartTime",
+        "TrainingEndTime",
+    ),
+    "ProcessingJob": (
+        "describe_processing_job",
+        "ProcessingJobName",
+        "ProcessingStartTime",
+        "ProcessingEndTime",
+    ),
+    "TransformJob": (
+        "describe_transform_job",
+        "TransformJobName",
+        "TransformStartTime",
+        "TransformEndTime",
+    ),
+}
+
+STEPS_DTYPE = np.dtype(
+    [
+        ("execution", "U256"),
+        ("step", "U64"),
+        ("type", "U32"),
+        ("status", "U16"),
+        ("start", "f8"),
+        ("duration", "f8"),
+        ("queue_time", "f8"),
+        ("run_time", "f8"),
+        ("cache_hit", "?"),
+        ("critical", "?"),
+    ]
+)
+SUMMARY_DTYPE = np.dtype(
+    [
+        ("step", "U64"),
+        ("count", "i8"),
+        ("duration_mean", "f8"),
+        ("duration_p50", "f8"),
+        ("duration_p90", "f8"),
+        ("duration_max", "f8"),
+        ("queue_time_mean", "f8"),
+        ("run_time_mean", "f8"),
+        ("cache_hit_rate", "f8"),
+        ("critical_share", "f8"),
+    ]
+)
+
+
+@dataclass
+class StepProfile:  # pylint: disable=too-many-instance-attributes
+    """
+    Timing of a single pipeline execution step, times are epoch seconds.
+    `job_start`/`job_end` are set for steps backed by Sagemaker jobs
+    """
+
+    name: str
+    type: str
+    status: str
+    start: Optional[float] = None
+    end: Optional[float] = None
+    job_start: Optional[float] = None
+    job_end: Optional[float] = None
+    cache_hit: bool = False
+    job_arn: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """Step wall-clock time"""
+        if self.start is None or self.end is None:
+            return float("nan")
+        return self.end - self.start
+
+    @property
+    def queue_time(self) -> float:
+        """Time from step start till its job started running (instance provisioning, image pulling)"""
+        if self.start is None or self.job_start is None:
+            return float("nan")
+        return max(self.job_start - self.start, 0.0)
+
+    @property
+    def run_time(self) -> float:
+        """Job running time"""
+        if self.job_start is None or self.job_end is None:
+            return float("nan")
+        return self.job_end - self.job_start
+
+
+@dataclass
+class ExecutionProfile:
+    """Steps of a pipeline execution with their dependencies"""
+
+    arn: str
+    status: str
+    steps: List[StepProfile]
+    dependencies: Dict[str, List[str]] = field(default_factory=dict)
+
+    def critical_path(self) -> List[str]:
+        """
+        Chain of steps which determined execution wall-clock time.
+        Starting from the last finished step, the latest finished upstream step is taken;
+        steps missing in the definition dependencies (e.g. condition branches) fall back
+        to the latest step finished before they started.
+        :return: step names in execution order
+        """
+        finished = {s.name: s for s in self.steps if s.end is not None}
+        if not finished:
+            return []
+        current = max(finished.values(), key=lambda s: s.end)
+        path = [current.name]
+        while True:
+            upstream = [
+                finished[name]
+                for name in self.dependencies.get(current.name, [])
+                if name in finished
+            ] or [
+                s
+                for s in finished.values()
+                if s.name not in path and s.end <= (current.start or current.end)
+            ]
+            if not upstream:
+                return path[::-1]
+            current = max(upstream, key=lambda s: s.end)
+            path.append(current.name)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """
+        Timeline in Chrome trace event format (chrome://tracing, https://ui.perfetto.dev),
+        queueing and running phases of job steps are separate slices
+        :return: trace JSON object
+        """
+        critical = set(self.critical_path())
+        origin = min((s.start for s in self.steps if s.start is not None), default=0.0)
+        ordered_steps = sorted(self.steps, key=lambda s: s.start or 0.0)
+        events = []
+        for lane, step in enumerate(ordered_steps):
+            if step.start is None or step.end is None:
+                continue
+            args = {
+                "status": step.status,
+                "cache_hit": step.cache_hit,
+                "critical": step.name in critical,
+            }
+            events.append(
+                _trace_event(
+                    step.name, step.type, step.start, step.end, origin, lane, args
+                )
+            )
+            if step.job_start is not None and step.job_end is not None:
+                events.append(
+                    _trace_event(
+                        "queue", "queue", step.start, step.job_start, origin, lane, {}
+                    )
+                )
+                events.append(
+                    _trace_event(
+                        "run", "run", step.job_start, step.job_end, origin, lane, {}
+                    )
+                )
+        events += [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 0,
+                "tid": lane,
+                "args": {"name": step.name},
+            }
+            for lane, step in enumerate(ordered_steps)
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"execution": self.arn},
+        }
+
+
+class PipelineProfiler:  # pylint: disable=too-few-public-methods
+    """
+    Collects step timings of pipeline executions.
+    Executions are fetched concurrently, finished ones are cached on disk and never fetched again.
+
+    Example:
+    >>> profiles = PipelineProfiler(boto3.client("sagemaker")).fetch("a_cool_pipeline_name", max_executions=200)
+    >>> write_csv(step_summary(profiles), "summary.csv")
+    """
+
+    def __init__(
+        self,
+        sagemaker_client: BaseClient,
+        cache_dir: Optional[str] = None,
+        max_workers: int = 8,
+        describe_jobs: bool = True,
+    ):
+        """
+        :param sagemaker_client: An instance of `boto3.client("sagemaker")`.
+        :param cache_dir: directory for finished execution profiles, `DEFAULT_CACHE_DIR` if not set
+        :param max_workers: number of executions fetched concurrently
+        :param describe_jobs: describe jobs behind steps to split step time into queueing and running
+        """
+        self.sagemaker_client = sagemaker_client
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_workers = max_workers
+        self.describe_jobs = describe_jobs
+
+    def fetch(
+        self, pipeline_name: str, max_executions: Optional[int] = None
+    ) -> List[ExecutionProfile]:
+        """
+        Profiles of the most recent pipeline executions
+        :param pipeline_name: Sagemaker pipeline name
+        :param max_executions: max number of executions, all if not set
+        :return: execution profiles, most recent first
+        """
+        summaries = []
+        for summary in self._paginate(
+            "list_pipeline_executions",
+            "PipelineExecutionSummaries",
+            PipelineName=pipeline_name,
+            SortBy="CreationTime",
+            SortOrder="Descending",
+        ):
+            if max_executions is not None and len(summaries) >= max_executions:
+                break
+            summaries.append(summary)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self._get_profile, summaries))
+
+    def _get_profile(self, summary: Dict[str, Any]) -> ExecutionProfile:
+        arn = summary["PipelineExecutionArn"]
+        cache_path = self.cache_dir / f"{quote(arn, safe='')}.json"
+        if cache_path.exists():
+            return _load_profile(cache_path)
+        profile = self._fetch_profile(arn, summary["PipelineExecutionStatus"])
+        if profile.status in TERMINAL_STATUSES:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(json.dumps(asdict(profile)), encoding="utf-8")
+        return profile
+
+    def _fetch_profile(self, arn: str, status: str) -> ExecutionProfile:
+        steps = [
+            self._step_profile(step)
+            for step in self._paginate(
+                "list_pipeline_execution_steps",
+                "PipelineExecutionSteps",
+                PipelineExecutionArn=arn,
+            )
+        ]
+        try:
+            definition = json.loads(
+                self.sagemaker_client.describe_pipeline_definition_for_execution(
+                    PipelineExecutionArn=arn
+                )["PipelineDefinition"]
+            )
+            dependencies = {
+                name: sorted(upstream)
+                for name, upstream in helpers.get_step_dependencies(definition).items()
+            }
+        except (ClientError, ValueError) as error:
+            logger.warning("No step dependencies for %s: %s", arn, error)
+            dependencies = {}
+        return ExecutionProfile(
+            arn=arn, status=status, steps=steps, dependencies=dependencies
+        )
+
+    def _step_profile(self, step: Dict[str, Any]) -> StepProfile:
+        metadata = step.get("Metadata", {})
+        step_type = next(iter(metadata), "Unknown")
+        profile = StepProfile(
+            name=step["StepName"],
+            type=step_type,
+            status=step.get("StepStatus", "Unknown"),
+            start=_timestamp(step.get("StartTime")),
+            end=_timestamp(step.get("EndTime")),
+            cache_hit="CacheHitResult" in step,
+            job_arn=metadata.get(step_type, {}).get("Arn"),
+        )
+        if (
+            self.describe_jobs
+            and step_type in _JOB_DESCRIPTIONS
+            and profile.job_arn
+            and not profile.cache_hit
+        ):
+            operation, name_arg, start_attr, end_attr = _JOB_DESCRIPTIONS[step_type]
+            job = getattr(self.sagemaker_client, operation)(
+                **{name_arg: profile.job_arn[profile.job_arn.rindex("/") + 1 :]}
+            )
+            profile.job_start = _timestamp(job.get(start_attr))
+            profile.job_end = _timestamp(job.get(end_attr))
+        return profile
+
+    def _paginate(
+        self, operation: str, result_key: str, **kwargs
+    ) -> Iterator[Dict[str, Any]]:
+        for page in self.sagemaker_client.get_paginator(operation).paginate(**kwargs):
+            yield from page[result_key]
+
+
+def steps_table(profiles: List[ExecutionProfile]) -> np.ndarray:
+    """
+    All steps of all executions as a columnar (structured) array, times are in seconds
+    :param profiles: execution profiles
+    :return: array of `STEPS_DTYPE`
+    """
+    rows = []
+    for profile in profiles:
+        critical = set(profile.critical_path())
+        rows += [
+            (
+                profile.arn,
+                step.name,
+                step.type,
+                step.status,
+                step.start if step.start is not None else np.nan,
+                step.duration,
+                step.queue_time,
+                step.run_time,
+                step.cache_hit,
+                step.name in critical,
+            )
+            for step in profile.steps
+        ]
+    return np.array(rows, dtype=STEPS_DTYPE)
+
+
+def step_summary(profiles: List[ExecutionProfile]) -> np.ndarray:
+    """
+    Per step distribution of durations, queueing and running time, cache-hit rate
+    and the share of executions where the step was on the critical path
+    :param profiles: execution profiles
+    :return: array of `SUMMARY_DTYPE` sorted by total time spent on the critical path
+    """
+    table = steps_table(profiles)
+    rows = []
+    for step in np.unique(table["step"]):
+        rows_of_step = table[table["step"] == step]
+        durations = rows_of_step["duration"]
+        rows.append(
+            (
+                step,
+                len(rows_of_step),
+                _nan_stat(np.nanmean, durations),
+                _nan_stat(np.nanpercentile, durations, 50),
+                _nan_stat(np.nanpercentile, durations, 90),
+                _nan_stat(np.nanmax, durations),
+                _nan_stat(np.nanmean, rows_of_step["queue_time"]),
+                _nan_stat(np.nanmean, rows_of_step["run_time"]),
+                rows_of_step["cache_hit"].mean(),
+                rows_of_step["critical"].mean(),
+            )
+        )
+    summary = np.array(rows, dtype=SUMMARY_DTYPE)
+    critical_time = np.nan_to_num(summary["duration_mean"]) * summary["critical_share"]
+    return summary[np.argsort(-critical_time, kind="stable")]
+
+
+def write_csv(table: np.ndarray, path: str) -> None:
+    """
+    Write structured array as CSV
+    :param table: array returned by `steps_table` or `step_summary`
+    :param path: destination file path
+    """
+    with open(path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(table.dtype.names)
+        writer.writerows(row.tolist() for row in table)
+
+
+def write_chrome_traces(profiles: List[ExecutionProfile], output_dir: str) -> List[str]:
+    """
+    Write Chrome trace file per execution
+    :param profiles: execution profiles
+    :param output_dir: destination directory
+    :return: written file paths
+    """
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    paths = []
+    for profile in profiles:
+        path = (
+            Path(output_dir) / f"{profile.arn[profile.arn.rindex('/') + 1:]}.trace.json"
+        )
+        path.write_text(json.dumps(profile.to_chrome_trace()), encoding="utf-8")
+        paths.append(str(path))
+    return paths
+
+
+def _load_profile(path: Path) -> ExecutionProfile:
+    data = json.loads(path.read_text(encoding="utf-8"))
+    data["steps"] = [StepProfile(**step) for step in data["steps"]]
+    return ExecutionProfile(**data)
+
+
+def _timestamp(value: Optional[datetime]) -> Optional[float]:
+    return value.timestamp() if value is not None else None
+
+
+def _nan_stat(func, values: np.ndarray, *args) -> float:
+    if np.isnan(values).all():
+        return float("nan")
+    return float(func(values, *args))
+
+
+def _trace_event(
+    name: str,
+    category: str,
+    start: float,
+    end: float,
+    origin: float,
+    lane: int,
+    args: Dict[str, Any],
+) -> Dict[str, Any]:
+    return {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": (start - origin) * 1e6,
+        "dur": (end - start) * 1e6,
+        "pid": 0,
+        "tid": lane,
+        "args": args,
+    }
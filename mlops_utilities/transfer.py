@@ -0,0 +1,428 @@
+"""Parallel transfer of model artifacts and pipeline files between S3 and local disk"""
+import hashlib
+import logging
+import math
+import mmap
+import os
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, List
+
+from botocore.client import BaseClient  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
+
+from mlops_utilities import helpers
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# S3 multipart upload limits: every part but the last is at least 5 MB, at most 10,000 parts
+_MIN_PART_SIZE = 5 * MB
+_MAX_PARTS = 10_000
+# files are hashed in chunks of this size, so parts are never read into memory as a whole
+_HASH_CHUNK_SIZE = MB
+
+
+@dataclass
+class TransferConfig:
+    """
+    :param part_size: size of a ranged GET / multipart upload part in bytes,
+        uploads raise it to the S3 limits (at least 5 MB, at most 10,000 parts)
+    :param max_workers: number of parts transferred concurrently
+    :param skip_if_same_etag: skip transfer if destination has the same ETag
+    """
+
+    part_size: int = 8 * MB
+    max_workers: int = 8
+    skip_if_same_etag: bool = True
+
+
+DEFAULT_TRANSFER_CONFIG = TransferConfig()
+
+
+def compute_etag(path: str, part_size: int) -> str:
+    """
+    Compute S3 ETag of a local file as if it was uploaded with the given part size
+    :param path: local file path
+    :param part_size: multipart upload part size
+    :return: ETag without quotes
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        if size <= part_size:
+            return _md5(file, size).hexdigest()
+        part_digests = [
+            _md5(file, len(byte_range)).digest()
+            for byte_range in _split_ranges(size, part_size)
+        ]
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+def download_file(
+    s3_client: BaseClient,
+    s3_uri: str,
+    local_path: str,
+    config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+) -> bool:
+    """
+    Download S3 object with concurrent ranged GETs written straight into a memory-mapped temporary file,
+    which replaces `local_path` only if all parts were downloaded.
+
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param s3_uri: S3 URI of the object
+    :param local_path: destination file path
+    :param config: transfer configuration
+    :return: False if the download was skipped because local file has the same ETag
+    """
+    bucket, key = helpers.split_s3_uri(s3_uri)
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    size, etag = head["ContentLength"], head["ETag"].strip('"')
+    if config.skip_if_same_etag and _local_etag_matches(
+        local_path, size, etag, config.part_size
+    ):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Skip download of %s, %s has the same ETag", s3_uri, local_path)
+        return False
+
+    Path(local_path).parent.mkdir(parents=True, exist_ok=True)
+    # existing file is replaced only once all parts are downloaded
+    tmp_path = Path(local_path).with_name(
+        f".{Path(local_path).name}.{os.getpid()}.{threading.get_ident()}.part"
+    )
+    try:
+        with open(tmp_path, "wb+") as file:
+            if size > 0:
+                file.truncate(size)
+                with mmap.mmap(file.fileno(), size) as mapped_file:
+                    _download_ranges(
+                        s3_client, bucket, key, head["ETag"], mapped_file, config
+                    )
+        os.replace(tmp_path, local_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return True
+
+
+def upload_file(
+    s3_client: BaseClient,
+    local_path: str,
+    s3_uri: str,
+    config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+) -> bool:
+    """
+    Upload local file, files larger than a part are uploaded with concurrent multipart upload.
+
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param local_path: source file path
+    :param s3_uri: destination S3 URI
+    :param config: transfer configuration
+    :return: False if the upload was skipped because S3 object has the same ETag
+    """
+    bucket, key = helpers.split_s3_uri(s3_uri)
+    size = os.path.getsize(local_path)
+    part_size = _upload_part_size(size, config.part_size)
+    if part_size != config.part_size and logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "Part size %d is out of S3 limits for %s, using %d",
+            config.part_size,
+            local_path,
+            part_size,
+        )
+    if config.skip_if_same_etag and _remote_etag_matches(
+        s3_client, bucket, key, local_path, part_size
+    ):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Skip upload of %s, %s has the same ETag", local_path, s3_uri)
+        return False
+
+    if size <= part_size:
+        with open(local_path, "rb") as file:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=file.read())
+        return True
+
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    try:
+        with open(local_path, "rb") as file, mmap.mmap(
+            file.fileno(), size, access=mmap.ACCESS_READ
+        ) as mapped_file:
+            ranges = _split_ranges(size, part_size)
+            with ThreadPoolExecutor(max_workers=config.max_workers) as executor:
+                parts = list(
+                    executor.map(
+                        lambda part: _upload_part(
+                            s3_client, bucket, key, upload_id, mapped_file, *part
+                        ),
+                        enumerate(ranges, start=1),
+                    )
+                )
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return True
+
+
+def download_prefix(
+    s3_client: BaseClient,
+    s3_uri: str,
+    local_dir: str,
+    config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+) -> List[str]:
+    """
+    Download all objects under S3 prefix preserving relative paths
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param s3_uri: S3 prefix
+    :param local_dir: destination directory
+    :param config: transfer configuration, both files and parts of every file are downloaded concurrently
+    :return: local paths of downloaded (or already up-to-date) files
+    """
+    bucket, prefix = helpers.split_s3_uri(s3_uri)
+    paginator = s3_client.get_paginator("list_objects_v2")
+    keys = [
+        obj["Key"]
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get("Contents", [])
+        if not obj["Key"].endswith("/")
+    ]
+    local_paths = [
+        str(
+            Path(local_dir)
+            / (os.path.relpath(key, prefix) if key != prefix else Path(key).name)
+        )
+        for key in keys
+    ]
+    with ThreadPoolExecutor(max_workers=config.max_workers) as executor:
+        list(
+            executor.map(
+                lambda key, local_path: download_file(
+                    s3_client, f"s3://{bucket}/{key}", local_path, config
+                ),
+                keys,
+                local_paths,
+            )
+        )
+    return local_paths
+
+
+def extract_tar(
+    s3_client: BaseClient, s3_uri: str, local_dir: str, read_size: int = 8 * MB
+) -> List[str]:
+    """
+    Extract tar (e.g. model.tar.gz) while it is being downloaded, no temporary copy of the archive is made
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param s3_uri: S3 URI of the archive
+    :param local_dir: destination directory
+    :param read_size: size of reads from the response stream
+    :return: names of extracted members
+    """
+    bucket, key = helpers.split_s3_uri(s3_uri)
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    with tarfile.open(fileobj=body, mode="r|*", bufsize=read_size) as archive:
+        names = []
+        for member in archive:
+            if not _is_within(local_dir, member.name):
+                raise ValueError(
+                    f"Archive member {member.name} is outside of {local_dir}"
+                )
+            archive.extract(member, local_dir)
+            names.append(member.name)
+    return names
+
+
+def download_model(
+    sagemaker_client: BaseClient,
+    s3_client: BaseClient,
+    model_name: str,
+    local_dir: str,
+    extract: bool = False,
+    config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+) -> str:
+    """
+    Download model artifact of a Sagemaker model
+    :param sagemaker_client: An instance of `boto3.client("sagemaker")`.
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param model_name: The name of the model.
+    :param local_dir: destination directory
+    :param extract: stream-extract the artifact into `local_dir` instead of saving the archive
+    :param config: transfer configuration
+    :return: path of the downloaded archive or `local_dir` if extracted
+    """
+    model_data_url = helpers.get_model_location(sagemaker_client, model_name)
+    if extract:
+        extract_tar(s3_client, model_data_url, local_dir, config.part_size)
+        return local_dir
+    local_path = str(
+        Path(local_dir) / Path(helpers.split_s3_uri(model_data_url)[1]).name
+    )
+    download_file(s3_client, model_data_url, local_path, config)
+    return local_path
+
+
+def download_processing_output(
+    sagemaker_client: BaseClient,
+    s3_client: BaseClient,
+    processing_job_arn: str,
+    output_name: str,
+    local_dir: str,
+    config: TransferConfig = DEFAULT_TRANSFER_CONFIG,
+) -> List[str]:
+    """
+    Download processing job output
+    :param sagemaker_client: An instance of `boto3.client("sagemaker")`.
+    :param s3_client: An instance of `boto3.client("s3")`.
+    :param processing_job_arn: The ARN of the processing job.
+    :param output_name: The name of the output.
+    :param local_dir: destination directory
+    :param config: transfer configuration
+    :return: local paths of downloaded files
+    """
+    return download_prefix(
+        s3_client,
+        helpers.get_output_destination(
+            sagemaker_client, processing_job_arn, output_name
+        ),
+        local_dir,
+        config,
+    )
+
+
+def _md5(file: BinaryIO, length: int) -> "hashlib._Hash":
+    """MD5 of the next `length` bytes of the file"""
+    digest = hashlib.md5()
+    while length > 0:
+        chunk = file.read(min(_HASH_CHUNK_SIZE, length))
+        if not chunk:
+            break
+        digest.update(chunk)
+        length -= len(chunk)
+    return digest
+
+
+def _upload_part_size(size: int, part_size: int) -> int:
+    """Part size within S3 multipart upload limits, raised to whole MBs if needed"""
+    if size <= part_size:
+        return part_size
+    part_size = max(part_size, _MIN_PART_SIZE)
+    if math.ceil(size / part_size) > _MAX_PARTS:
+        part_size = math.ceil(size / _MAX_PARTS / MB) * MB
+    return part_size
+
+
+def _split_ranges(size: int, part_size: int) -> List[range]:
+    return [
+        range(start, min(start + part_size, size))
+        for start in range(0, size, part_size)
+    ]
+
+
+def _download_ranges(
+    s3_client: BaseClient,
+    bucket: str,
+    key: str,
+    etag: str,
+    mapped_file: mmap.mmap,
+    config: TransferConfig,
+) -> None:
+    ranges = _split_ranges(len(mapped_file), config.part_size)
+    with ThreadPoolExecutor(max_workers=config.max_workers) as executor:
+        # IfMatch guarantees that all parts belong to the same object version
+        list(
+            executor.map(
+                lambda byte_range: _download_range(
+                    s3_client, bucket, key, etag, mapped_file, byte_range
+                ),
+                ranges,
+            )
+        )
+    mapped_file.flush()
+
+
+def _download_range(
+    s3_client: BaseClient,
+    bucket: str,
+    key: str,
+    etag: str,
+    mapped_file: mmap.mmap,
+    byte_range: range,
+) -> None:
+    response = s3_client.get_object(
+        Bucket=bucket,
+        Key=key,
+        Range=f"bytes={byte_range.start}-{byte_range.stop - 1}",
+        IfMatch=etag,
+    )
+    mapped_file[byte_range.start : byte_range.stop] = response["Body"].read()
+
+
+def _upload_part(
+    s3_client: BaseClient,
+    bucket: str,
+    key: str,
+    upload_id: str,
+    mapped_file: mmap.mmap,
+    part_number: int,
+    byte_range: range,
+) -> Dict[str, object]:
+    response = s3_client.upload_part(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=mapped_file[byte_range.start : byte_range.stop],
+    )
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+def _local_etag_matches(local_path: str, size: int, etag: str, part_size: int) -> bool:
+    if not os.path.isfile(local_path) or os.path.getsize(local_path) != size:
+        return False
+    return any(
+        compute_etag(local_path, candidate) == etag
+        for candidate in _candidate_part_sizes(size, etag, part_size)
+    )
+
+
+def _remote_etag_matches(
+    s3_client: BaseClient, bucket: str, key: str, local_path: str, part_size: int
+) -> bool:
+    try:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        return False
+    size = os.path.getsize(local_path)
+    if head["ContentLength"] != size:
+        return False
+    etag = head["ETag"].strip('"')
+    return any(
+        compute_etag(local_path, candidate) == etag
+        for candidate in _candidate_part_sizes(size, etag, part_size)
+    )
+
+
+def _candidate_part_sizes(size: int, etag: str, part_size: int) -> List[int]:
+    """
+    Multipart ETag depends on the part size the object was uploaded with,
+    besides the configured one try the one `upload_file` adjusts it to
+    and the size derived from the part count rounded up to MB
+    """
+    if "-" not in etag:
+        return [max(size, 1)]
+    part_count = int(etag.rsplit("-", 1)[1])
+    derived = math.ceil(size / part_count / MB) * MB
+    return list(dict.fromkeys([part_size, _upload_part_size(size, part_size), derived]))
+
+
+def _is_within(directory: str, member_name: str) -> bool:
+    root = os.path.realpath(directory)
+    member_path = os.path.realpath(os.path.join(root, member_name))
+    return member_path == root or member_path.startswith(root + os.sep)
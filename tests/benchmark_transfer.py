@@ -0,0 +1,57 @@
+"""
+Throughput of parallel artifact transfer vs concurrency against the in-memory S3 stand-in.
+Every request is delayed by `--latency` and limited by `--bandwidth` to emulate a single S3 connection.
+
+Run:
+    python -m tests.benchmark_transfer --size-mb 64 --part-size-mb 8
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from mlops_utilities import transfer
+from tests.fake_s3 import FakeS3Client
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--part-size-mb", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--bandwidth-mb", type=float, default=50.0)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    s3_client = FakeS3Client(
+        latency=args.latency, bandwidth=args.bandwidth_mb * transfer.MB
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = Path(tmp_dir) / "model.tar.gz"
+        source.write_bytes(os.urandom(args.size_mb * transfer.MB))
+        print(f"{'workers':>8} {'upload MB/s':>12} {'download MB/s':>14}")
+        for max_workers in args.concurrency:
+            config = transfer.TransferConfig(
+                part_size=args.part_size_mb * transfer.MB,
+                max_workers=max_workers,
+                skip_if_same_etag=False,
+            )
+            start = time.perf_counter()
+            transfer.upload_file(
+                s3_client, str(source), "s3://bucket/model.tar.gz", config
+            )
+            upload_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            transfer.download_file(
+                s3_client, "s3://bucket/model.tar.gz", str(source) + ".out", config
+            )
+            download_time = time.perf_counter() - start
+            print(
+                f"{max_workers:>8} {args.size_mb / upload_time:>12.1f} {args.size_mb / download_time:>14.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""In-memory stand-in for boto3 S3 client"""
+import hashlib
+import io
+import itertools
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+class FakePaginator:
+    def __init__(self, client, page_size):
+        self.client = client
+        self.page_size = page_size
+
+    def paginate(self, Bucket, Prefix="", Delimiter=None):
+        with self.client.lock:
+            keys = sorted(
+                k for k in self.client.buckets.get(Bucket, {}) if k.startswith(Prefix)
+            )
+        contents, common_prefixes = [], []
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix) :]:
+                common_prefix = key[: key.index(Delimiter, len(Prefix)) + 1]
+                if not common_prefixes or common_prefixes[-1] != common_prefix:
+                    common_prefixes.append(common_prefix)
+            else:
+                contents.append(key)
+        for start in range(0, max(len(contents), 1), self.page_size):
+            page = {
+                "Contents": [
+                    self.client._summary(Bucket, key)
+                    for key in contents[start : start + self.page_size]
+                ]
+            }
+            if start == 0:
+                page["CommonPrefixes"] = [{"Prefix": p} for p in common_prefixes]
+            yield page
+
+
+class FakeS3Client:
+    """
+    :param page_size: max number of keys in a listing page
+    :param latency: seconds every object request takes, emulates network round trip
+    :param bandwidth: bytes per second of a single request, None for unlimited
+    """
+
+    def __init__(self, page_size=3, latency=0.0, bandwidth=None):
+        self.buckets = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.page_size = page_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = []
+        self._upload_ids = itertools.count()
+
+    def _request(self, operation, size=0):
+        with self.lock:
+            self.requests.append(operation)
+        time.sleep(self.latency + (size / self.bandwidth if self.bandwidth else 0))
+
+    def _get(self, bucket, key):
+        try:
+            return self.buckets[bucket][key]
+        except KeyError:
+            raise ClientError(
+                {"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject"
+            ) from None
+
+    def _summary(self, bucket, key):
+        body, etag = self.buckets[bucket][key]
+        return {"Key": key, "Size": len(body), "ETag": f'"{etag}"'}
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "list_objects_v2"
+        return FakePaginator(self, self.page_size)
+
+    def put_object(self, Bucket, Key, Body):
+        self._request("PutObject", len(Body))
+        with self.lock:
+            self.buckets.setdefault(Bucket, {})[Key] = (
+                Body,
+                hashlib.md5(Body).hexdigest(),
+            )
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            del self.buckets[Bucket][Key]
+
+    def download_file(self, Bucket, Key, Filename):
+        body, _ = self._get(Bucket, Key)
+        self._request("GetObject", len(body))
+        with open(Filename, "wb") as file:
+            file.write(body)
+
+    def head_object(self, Bucket, Key):
+        self._request("HeadObject")
+        body, etag = self._get(Bucket, Key)
+        return {"ContentLength": len(body), "ETag": f'"{etag}"'}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        body, etag = self._get(Bucket, Key)
+        if IfMatch is not None and IfMatch.strip('"') != etag:
+            raise ClientError(
+                {"Error": {"Code": "PreconditionFailed", "Message": ""}}, "GetObject"
+            )
+        if Range is not None:
+            start, end = Range[len("bytes=") :].split("-")
+            body = body[int(start) : int(end) + 1]
+        self._request("GetObject", len(body))
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self._request("CreateMultipartUpload")
+        upload_id = str(next(self._upload_ids))
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._request("UploadPart", len(Body))
+        body = bytes(Body)
+        etag = hashlib.md5(body).hexdigest()
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = (body, etag)
+        return {"ETag": f'"{etag}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request("CompleteMultipartUpload")
+        with self.lock:
+            uploaded = self.uploads.pop(UploadId)
+            parts = [uploaded[p["PartNumber"]] for p in MultipartUpload["Parts"]]
+            digest = hashlib.md5(
+                b"".join(bytes.fromhex(etag) for _, etag in parts)
+            ).hexdigest()
+            self.buckets.setdefault(Bucket, {})[Key] = (
+                b"".join(body for body, _ in parts),
+                f"{digest}-{len(parts)}",
+            )
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request("AbortMultipartUpload")
+        with self.lock:
+            self.uploads.pop(UploadId, None)
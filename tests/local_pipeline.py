@@ -0,0 +1,61 @@
+from omegaconf.dictconfig import DictConfig
+from sagemaker.inputs import TrainingInput  # type: ignore
+from sagemaker.processing import ProcessingOutput, ScriptProcessor  # type: ignore
+from sagemaker.sklearn.estimator import SKLearn  # type: ignore
+from sagemaker.workflow.parameters import ParameterString  # type: ignore
+from sagemaker.workflow.pipeline import Pipeline  # type: ignore
+from sagemaker.workflow.pipeline_context import PipelineSession  # type: ignore
+from sagemaker.workflow.steps import ProcessingStep, TrainingStep  # type: ignore
+
+
+def get_pipeline(
+    sm_session: PipelineSession, pipeline_name: str, conf: DictConfig
+) -> Pipeline:
+    rows = ParameterString(name="Rows", default_value="3")
+    processor = ScriptProcessor(
+        image_uri="python:3",
+        command=["python3"],
+        role=conf.pipeline.role,
+        instance_type="ml.m5.xlarge",
+        instance_count=1,
+        sagemaker_session=sm_session,
+    )
+    prep = ProcessingStep(
+        name="Prep",
+        step_args=processor.run(
+            code=conf.code.prep,
+            arguments=["--rows", rows, "--out", "/opt/ml/processing/train"],
+            outputs=[
+                ProcessingOutput(
+                    output_name="train", source="/opt/ml/processing/train"
+                )
+            ],
+        ),
+    )
+    estimator = SKLearn(
+        entry_point="train.py",
+        source_dir=conf.code.source_dir,
+        framework_version="1.2-1",
+        role=conf.pipeline.role,
+        instance_type="ml.m5.xlarge",
+        hyperparameters={"scale": 2},
+        sagemaker_session=sm_session,
+    )
+    train = TrainingStep(
+        name="Train",
+        step_args=estimator.fit(
+            {
+                "train": TrainingInput(
+                    prep.properties.ProcessingOutputConfig.Outputs[  # pylint: disable=no-member
+                        "train"
+                    ].S3Output.S3Uri
+                )
+            }
+        ),
+    )
+    return Pipeline(
+        name=pipeline_name,
+        parameters=[rows],
+        steps=[prep, train],
+        sagemaker_session=sm_session,
+    )
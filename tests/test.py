@@ -1,10 +1,54 @@
+import dataclasses
+import functools
+import importlib
+import json
+import os
 import random
 import string
+import subprocess
+import sys
+import tarfile
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
 
 import pytest
+from botocore.exceptions import ClientError
 
-from mlops_utilities import helpers
+from mlops_utilities import (
+    actions,
+    cleanup,
+    datasets,
+    helpers,
+    lineage,
+    local,
+    notebooks,
+    profiler,
+    transfer,
+)
 from mlops_utilities.actions import run_pipeline, upsert_pipeline
+from mlops_utilities.profiler import PipelineProfiler
+from sagemaker.workflow.pipeline_context import LocalPipelineSession, PipelineSession
+from tests.fake_s3 import FakeS3Client
+
+
+def _paged_client(pages):
+    """
+    Mocked boto3 client whose paginators yield `pages[operation]`,
+    callable values get the paginate() arguments and return the pages
+    """
+
+    def paginate(operation, **kwargs):
+        operation_pages = pages[operation]
+        return iter(
+            operation_pages(**kwargs) if callable(operation_pages) else operation_pages
+        )
+
+    client = MagicMock()
+    client.get_paginator.side_effect = lambda operation: MagicMock(
+        paginate=MagicMock(side_effect=functools.partial(paginate, operation))
+    )
+    return client
 
 
 class TestPackageActions:
@@ -101,3 +145,1171 @@ class TestHelpers:
             ],  # both by default
             "CaptureContentTypeHeader": {"CsvContentTypes": ["text/csv"]},
         }
+
+
+class TestLocalPipeline:
+    @staticmethod
+    def _definition(code_dir):
+        return {
+            "Parameters": [{"Name": "Rows", "Type": "String", "DefaultValue": "3"}],
+            "Steps": [
+                {
+                    "Name": "Prep",
+                    "Type": "Processing",
+                    "Arguments": {
+                        "AppSpecification": {
+                            "ContainerEntrypoint": [
+                                "python3",
+                                "/opt/ml/processing/input/code/prep.py",
+                            ],
+                            "ContainerArguments": [
+                                "--rows",
+                                {"Get": "Parameters.Rows"},
+                                "--out",
+                                "/opt/ml/processing/train",
+                            ],
+                        },
+                        "ProcessingInputs": [
+                            {
+                                "InputName": "code",
+                                "S3Input": {
+                                    "S3Uri": f"file://{code_dir}/prep.py",
+                                    "LocalPath": "/opt/ml/processing/input/code",
+                                },
+                            }
+                        ],
+                        "ProcessingOutputConfig": {
+                            "Outputs": [
+                                {
+                                    "OutputName": "train",
+                                    "S3Output": {
+                                        "S3Uri": "s3://bucket/train",
+                                        "LocalPath": "/opt/ml/processing/train",
+                                    },
+                                }
+                            ]
+                        },
+                    },
+                },
+                {
+                    "Name": "Train",
+                    "Type": "Training",
+                    "Arguments": {
+                        "HyperParameters": {
+                            "sagemaker_program": '"train.py"',
+                            "sagemaker_submit_directory": f'"file://{code_dir}"',
+                            "scale": "2",
+                        },
+                        "InputDataConfig": [
+                            {
+                                "ChannelName": "train",
+                                "DataSource": {
+                                    "S3DataSource": {
+                                        "S3Uri": {
+                                            "Get": "Steps.Prep.ProcessingOutputConfig.Outputs['train'].S3Output.S3Uri"
+                                        }
+                                    }
+                                },
+                            }
+                        ],
+                    },
+                },
+                {"Name": "Register", "Type": "RegisterModel", "DependsOn": ["Train"]},
+            ],
+        }
+
+    @staticmethod
+    def _write_code(code_dir):
+        code_dir.mkdir(exist_ok=True)
+        (code_dir / "prep.py").write_text(
+            "import argparse, os\n"
+            "p = argparse.ArgumentParser()\n"
+            "p.add_argument('--rows', type=int)\n"
+            "p.add_argument('--out')\n"
+            "a = p.parse_args()\n"
+            "open(os.path.join(a.out, 'data.txt'), 'w').write(str(a.rows))\n"
+        )
+        (code_dir / "train.py").write_text(
+            "import json, os, sys\n"
+            "rows = int(open(os.path.join(os.environ['SM_CHANNEL_TRAIN'], 'data.txt')).read())\n"
+            "scale = json.loads(os.environ['SM_HPS'])['scale']\n"
+            "assert sys.argv[1:] == ['--scale', str(scale)]\n"
+            "open(os.path.join(os.environ['SM_MODEL_DIR'], 'model.txt'), 'w').write(str(rows * scale))\n"
+        )
+
+    def test_run_and_cache(self, tmp_path):
+        code_dir = tmp_path / "code"
+        self._write_code(code_dir)
+        runner = local.LocalPipelineRunner(
+            self._definition(code_dir), tmp_path / "steps"
+        )
+
+        results = runner.run({"Rows": "5"})
+        assert {name: r.status for name, r in results.items()} == {
+            "Prep": local.STATUS_SUCCEEDED,
+            "Train": local.STATUS_SUCCEEDED,
+            "Register": local.STATUS_SKIPPED,
+        }
+        model_dir = results["Train"].outputs["model"]
+        assert open(f"{model_dir}/model.txt").read() == "10"
+
+        results = runner.run({"Rows": "5"})
+        assert results["Prep"].status == local.STATUS_CACHED
+        assert results["Train"].status == local.STATUS_CACHED
+
+        results = runner.run({"Rows": "6"})
+        assert results["Prep"].status == local.STATUS_SUCCEEDED
+        assert results["Train"].status == local.STATUS_SUCCEEDED
+
+    def test_condition_with_nested_steps(self, tmp_path):
+        code_dir = tmp_path / "code"
+        self._write_code(code_dir)
+        definition = self._definition(code_dir)
+        definition["Steps"].append(
+            {
+                "Name": "Cond",
+                "Type": "Condition",
+                "Arguments": {
+                    "Conditions": [
+                        {
+                            "Type": "GreaterThanOrEqualTo",
+                            "LeftValue": {"Get": "Parameters.Rows"},
+                            "RightValue": 1,
+                        }
+                    ],
+                    "IfSteps": [
+                        {
+                            "Name": "CreateModel",
+                            "Type": "Model",
+                            "Arguments": {
+                                "PrimaryContainer": {
+                                    "ModelDataUrl": {
+                                        "Get": "Steps.Train.ModelArtifacts.S3ModelArtifacts"
+                                    }
+                                }
+                            },
+                        },
+                        {
+                            "Name": "Transform",
+                            "Type": "Transform",
+                            "Arguments": {
+                                "ModelName": {"Get": "Steps.CreateModel.ModelName"}
+                            },
+                        },
+                    ],
+                    "ElseSteps": [],
+                },
+            }
+        )
+        assert helpers.get_step_dependencies(definition)["Cond"] == {"Train"}
+        results = local.LocalPipelineRunner(definition, tmp_path / "steps").run()
+        assert results["Cond"].status == local.STATUS_SKIPPED
+
+    def test_new_s3_data_invalidates_cache(self, tmp_path):
+        code_dir = tmp_path / "code"
+        self._write_code(code_dir)
+        definition = self._definition(code_dir)
+        definition["Steps"][0]["Arguments"]["ProcessingInputs"].append(
+            {
+                "InputName": "raw",
+                "S3Input": {
+                    "S3Uri": "s3://bucket/raw",
+                    "LocalPath": "/opt/ml/processing/raw",
+                },
+            }
+        )
+        s3_client = FakeS3Client()
+        s3_client.put_object(Bucket="bucket", Key="raw/part-0.csv", Body=b"1,2")
+        runner = local.LocalPipelineRunner(
+            definition, tmp_path / "steps", s3_client=s3_client
+        )
+        runner.run()
+        assert runner.run()["Prep"].status == local.STATUS_CACHED
+
+        s3_client.put_object(Bucket="bucket", Key="raw/part-1.csv", Body=b"3,4")
+        results = runner.run()
+        assert results["Prep"].status == local.STATUS_SUCCEEDED
+        assert sorted(os.listdir(f"{results['Prep'].step_dir}/inputs/raw")) == [
+            "part-0.csv",
+            "part-1.csv",
+        ]
+
+    def test_relative_work_dir(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        self._write_code(tmp_path / "code")
+        runner = local.LocalPipelineRunner(
+            self._definition("code"),
+            local.get_pipeline_dir("p", ".mlops_local") / "steps",
+        )
+        results = runner.run()
+        model_dir = results["Train"].outputs["model"]
+        assert os.path.isabs(model_dir)
+        assert open(f"{model_dir}/model.txt").read() == "6"
+
+    def test_code_change_invalidates_cache(self, tmp_path):
+        code_dir = tmp_path / "code"
+        self._write_code(code_dir)
+        runner = local.LocalPipelineRunner(
+            self._definition(code_dir), tmp_path / "steps"
+        )
+        runner.run()
+
+        with open(code_dir / "train.py", "a") as train_script:
+            train_script.write("# changed\n")
+        results = runner.run()
+        assert results["Prep"].status == local.STATUS_CACHED
+        assert results["Train"].status == local.STATUS_SUCCEEDED
+
+    def test_failed_step(self, tmp_path):
+        code_dir = tmp_path / "code"
+        self._write_code(code_dir)
+        (code_dir / "prep.py").write_text("raise SystemExit(1)")
+        runner = local.LocalPipelineRunner(
+            self._definition(code_dir), tmp_path / "steps"
+        )
+        with pytest.raises(RuntimeError):
+            runner.run()
+
+    def test_built_in_algorithm(self, tmp_path):
+        definition = self._definition(tmp_path)
+        definition["Steps"][1]["Arguments"]["HyperParameters"] = {"num_round": "10"}
+        with pytest.raises(ValueError, match="Training step Train"):
+            local.LocalPipelineRunner(definition, tmp_path / "steps")
+
+    def test_run_upserted_pipeline(self, tmp_path, monkeypatch):
+        code_dir = tmp_path / "code"
+        self._write_code(code_dir)
+        s3_client = FakeS3Client()
+        s3_client.put_object(
+            Bucket="bucket",
+            Key="code/prep.py",
+            Body=(code_dir / "prep.py").read_bytes(),
+        )
+        with tarfile.open(tmp_path / "sourcedir.tar.gz", "w:gz") as archive:
+            archive.add(code_dir / "train.py", arcname="train.py")
+        s3_client.put_object(
+            Bucket="bucket",
+            Key="code/sourcedir.tar.gz",
+            Body=(tmp_path / "sourcedir.tar.gz").read_bytes(),
+        )
+
+        monkeypatch.setattr(local, "DEFAULT_LOCAL_DIR", str(tmp_path / "pipelines"))
+        monkeypatch.setattr(
+            actions,
+            "LocalPipelineSession",
+            functools.partial(
+                LocalPipelineSession, boto_session=MagicMock(region_name="us-east-1")
+            ),
+        )
+        upsert_pipeline(
+            "tests",
+            "local_pipeline",
+            "local-pipeline",
+            "local_pipeline.defaults",
+            "arn:aws:iam::123456789000:role/AmazonSageMaker-ExecutionRole",
+            local_mode=True,
+        )
+        definition = local.load_pipeline_definition("local-pipeline")
+        results = local.LocalPipelineRunner(
+            definition, tmp_path / "steps", s3_client=s3_client
+        ).run({"Rows": "4"})
+        assert [results[name].status for name in ("Prep", "Train")] == [
+            local.STATUS_SUCCEEDED,
+            local.STATUS_SUCCEEDED,
+        ]
+        model_dir = results["Train"].outputs["model"]
+        with open(os.path.join(model_dir, "model.txt")) as model_file:
+            assert model_file.read() == "8"
+
+    def test_run_local_pipeline_dryrun(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(local, "DEFAULT_LOCAL_DIR", str(tmp_path))
+        local.save_pipeline_definition(
+            "test_pipeline", json.dumps(self._definition(tmp_path)), str(tmp_path)
+        )
+        assert run_pipeline(
+            pipeline_name="test_pipeline",
+            execution_name_prefix="test_pipeline",
+            pipeline_params={},
+            dryrun=True,
+            local_mode=True,
+        ) == {"Prep": "Processing", "Train": "Training", "Register": "RegisterModel"}
+
+
+class TestDatasets:
+    uri = "s3://bucket/datasets/abalone/"
+
+    @staticmethod
+    def _s3_client():
+        s3_client = FakeS3Client()
+        for part in range(3):
+            for row in range(4):
+                s3_client.put_object(
+                    Bucket="bucket",
+                    Key=f"datasets/abalone/part={part}/{row}.csv",
+                    Body=f"{part},{row}".encode(),
+                )
+        s3_client.put_object(
+            Bucket="bucket", Key="datasets/abalone/_meta.json", Body=b"{}"
+        )
+        s3_client.put_object(Bucket="bucket", Key="datasets/other.csv", Body=b"1")
+        return s3_client
+
+    def test_build_manifest(self, tmp_path):
+        manifest, diff = datasets.build_manifest(
+            self._s3_client(), self.uri, str(tmp_path)
+        )
+        keys = [entry.key for entry in manifest.entries()]
+        assert keys == sorted(keys)
+        assert len(keys) == manifest.object_count == diff.added == 13
+        assert "datasets/other.csv" not in keys
+
+    def test_merge_in_rounds(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(datasets, "_MAX_OPEN_PARTS", 2)
+        s3_client = self._s3_client()
+        for day in range(7):
+            s3_client.put_object(
+                Bucket="bucket",
+                Key=f"datasets/abalone/day={day}/0.csv",
+                Body=b"1",
+            )
+        manifest, _ = datasets.build_manifest(s3_client, self.uri, str(tmp_path))
+        keys = [entry.key for entry in manifest.entries()]
+        assert keys == sorted(keys)
+        assert len(keys) == 20
+
+    def test_version_is_independent_of_history(self, tmp_path):
+        s3_client = self._s3_client()
+        first = datasets.version_dataset(self.uri, str(tmp_path), s3_client)
+        s3_client.put_object(
+            Bucket="bucket", Key="datasets/abalone/part=1/0.csv", Body=b"changed"
+        )
+        s3_client.delete_object(Bucket="bucket", Key="datasets/abalone/part=2/3.csv")
+        s3_client.put_object(
+            Bucket="bucket", Key="datasets/abalone/part=3/0.csv", Body=b"new"
+        )
+        second = datasets.version_dataset(self.uri, str(tmp_path), s3_client)
+        assert second.version != first.version
+
+        rebuilt, _ = datasets.build_manifest(
+            s3_client, self.uri, str(tmp_path / "rebuilt")
+        )
+        assert rebuilt.digest == second.digest
+        _, diff = datasets.build_manifest(
+            s3_client, self.uri, str(tmp_path / "incremental"), previous=first
+        )
+        assert (diff.added, diff.removed, diff.modified) == (1, 1, 1)
+
+    def test_unchanged_dataset_keeps_version(self, tmp_path):
+        s3_client = self._s3_client()
+        first = datasets.version_dataset(self.uri, str(tmp_path), s3_client)
+        second = datasets.version_dataset(self.uri, str(tmp_path), s3_client)
+        assert first.version == second.version
+        assert (
+            datasets.load_latest_manifest(
+                datasets.get_dataset_manifest_dir(self.uri, str(tmp_path))
+            ).digest
+            == first.digest
+        )
+
+    def test_add_dataset_versions(self, tmp_path):
+        params = datasets.add_dataset_versions(
+            {"InputDataS3Uri": self.uri, "RegisterModel": False},
+            ["InputDataS3Uri"],
+            str(tmp_path),
+            self._s3_client(),
+        )
+        assert len(params["InputDataS3UriVersion"]) == 16
+        assert params["InputDataS3Uri"] == self.uri
+
+    def test_dryrun_keeps_history(self, tmp_path):
+        s3_client = self._s3_client()
+        first = datasets.version_dataset(self.uri, str(tmp_path), s3_client)
+        manifest_dir = datasets.get_dataset_manifest_dir(self.uri, str(tmp_path))
+        stored = sorted(os.listdir(manifest_dir))
+
+        s3_client.put_object(
+            Bucket="bucket", Key="datasets/abalone/part=1/0.csv", Body=b"changed"
+        )
+        params = datasets.add_dataset_versions(
+            {"InputDataS3Uri": self.uri},
+            ["InputDataS3Uri"],
+            str(tmp_path),
+            s3_client,
+            dryrun=True,
+        )
+        assert params["InputDataS3UriVersion"] != first.version
+        assert sorted(os.listdir(manifest_dir)) == stored
+        assert datasets.load_latest_manifest(manifest_dir).digest == first.digest
+        assert (
+            datasets.version_dataset(self.uri, str(tmp_path), s3_client).version
+            == params["InputDataS3UriVersion"]
+        )
+
+
+class TestTransfer:
+    config = transfer.TransferConfig(part_size=1024, max_workers=4)
+
+    @pytest.fixture(autouse=True)
+    def small_parts(self, monkeypatch):
+        # the fake S3 accepts parts below the S3 minimum
+        monkeypatch.setattr(transfer, "_MIN_PART_SIZE", 1024)
+
+    def test_multipart_upload_and_ranged_download(self, tmp_path):
+        s3_client = FakeS3Client()
+        source = tmp_path / "model.tar.gz"
+        source.write_bytes(os.urandom(10_000))
+
+        assert transfer.upload_file(
+            s3_client, str(source), "s3://bucket/model.tar.gz", self.config
+        )
+        assert s3_client.requests.count("UploadPart") == 10
+        assert s3_client.head_object(Bucket="bucket", Key="model.tar.gz")[
+            "ETag"
+        ] == '"{}"'.format(transfer.compute_etag(str(source), self.config.part_size))
+
+        target = tmp_path / "downloaded" / "model.tar.gz"
+        assert transfer.download_file(
+            s3_client, "s3://bucket/model.tar.gz", str(target), self.config
+        )
+        assert target.read_bytes() == source.read_bytes()
+        assert s3_client.requests.count("GetObject") == 10
+
+    def test_skip_if_same_etag(self, tmp_path):
+        s3_client = FakeS3Client()
+        source = tmp_path / "model.tar.gz"
+        source.write_bytes(os.urandom(3000))
+        transfer.upload_file(s3_client, str(source), "s3://bucket/m", self.config)
+        assert not transfer.upload_file(
+            s3_client, str(source), "s3://bucket/m", self.config
+        )
+        assert not transfer.download_file(
+            s3_client, "s3://bucket/m", str(source), self.config
+        )
+        source.write_bytes(os.urandom(3000))
+        assert transfer.download_file(
+            s3_client, "s3://bucket/m", str(source), self.config
+        )
+
+    def test_part_size_within_s3_limits(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(transfer, "_MIN_PART_SIZE", 2048)
+        s3_client = FakeS3Client()
+        source = tmp_path / "model.tar.gz"
+        source.write_bytes(os.urandom(10_000))
+
+        transfer.upload_file(s3_client, str(source), "s3://bucket/small", self.config)
+        assert s3_client.requests.count("UploadPart") == 5
+        assert not transfer.upload_file(
+            s3_client, str(source), "s3://bucket/small", self.config
+        )
+
+        monkeypatch.setattr(transfer, "_MAX_PARTS", 4)
+        large = tmp_path / "large.bin"
+        large.write_bytes(os.urandom(5 * transfer.MB))
+        transfer.upload_file(s3_client, str(large), "s3://bucket/large", self.config)
+        etag = s3_client.head_object(Bucket="bucket", Key="large")["ETag"]
+        assert etag.strip('"').endswith("-3")
+        assert etag.strip('"') == transfer.compute_etag(str(large), 2 * transfer.MB)
+        assert not transfer.download_file(
+            s3_client, "s3://bucket/large", str(large), self.config
+        )
+
+    def test_failed_download_keeps_existing_file(self, tmp_path):
+        s3_client = FakeS3Client()
+        s3_client.put_object(Bucket="bucket", Key="m", Body=os.urandom(3000))
+        target = tmp_path / "model.tar.gz"
+        target.write_bytes(b"previous version")
+        # object replaced between HEAD and ranged GETs
+        head_object = s3_client.head_object
+        s3_client.head_object = lambda **kwargs: {
+            **head_object(**kwargs),
+            "ETag": '"stale"',
+        }
+        with pytest.raises(ClientError):
+            transfer.download_file(s3_client, "s3://bucket/m", str(target), self.config)
+        assert target.read_bytes() == b"previous version"
+        assert os.listdir(tmp_path) == ["model.tar.gz"]
+
+    def test_download_model_extract(self, tmp_path):
+        s3_client = FakeS3Client()
+        archive_path = tmp_path / "model.tar.gz"
+        (tmp_path / "model.joblib").write_bytes(b"model")
+        with tarfile.open(archive_path, "w:gz") as archive:
+            archive.add(tmp_path / "model.joblib", arcname="model.joblib")
+        s3_client.put_object(
+            Bucket="bucket", Key="output/model.tar.gz", Body=archive_path.read_bytes()
+        )
+        sagemaker_client = MagicMock()
+        sagemaker_client.describe_model.return_value = {
+            "PrimaryContainer": {"ModelDataUrl": "s3://bucket/output/model.tar.gz"}
+        }
+
+        local_dir = transfer.download_model(
+            sagemaker_client, s3_client, "model", str(tmp_path / "model"), extract=True
+        )
+        assert (tmp_path / "model" / "model.joblib").read_bytes() == b"model"
+        local_path = transfer.download_model(
+            sagemaker_client, s3_client, "model", local_dir
+        )
+        assert local_path == str(tmp_path / "model" / "model.tar.gz")
+
+    def test_download_processing_output(self, tmp_path):
+        s3_client = FakeS3Client()
+        for name in ("train.csv", "nested/test.csv"):
+            s3_client.put_object(Bucket="bucket", Key=f"prep/{name}", Body=b"1,2")
+        sagemaker_client = MagicMock()
+        sagemaker_client.describe_processing_job.return_value = {
+            "ProcessingOutputConfig": {
+                "Outputs": [
+                    {"OutputName": "train", "S3Output": {"S3Uri": "s3://bucket/prep"}}
+                ]
+            }
+        }
+        local_paths = transfer.download_processing_output(
+            sagemaker_client,
+            s3_client,
+            "arn:aws:sagemaker:us-east-1:123456789000:processing-job/prep",
+            "train",
+            str(tmp_path),
+        )
+        assert sorted(local_paths) == [
+            str(tmp_path / "nested" / "test.csv"),
+            str(tmp_path / "train.csv"),
+        ]
+
+
+class TestCleanup:
+    now = datetime(2023, 6, 1, tzinfo=timezone.utc)
+
+    def _sagemaker_client(self):
+        old = self.now - timedelta(days=30)
+        pages = {
+            "list_endpoints": [{"Endpoints": [{"EndpointName": "endpoint"}]}],
+            "list_endpoint_configs": [
+                {
+                    "EndpointConfigs": [
+                        {
+                            "EndpointConfigName": f"config-{i}",
+                            "EndpointConfigArn": f"arn:config-{i}",
+                            "CreationTime": old + timedelta(days=i),
+                        }
+                        for i in range(3)
+                    ]
+                },
+                {
+                    "EndpointConfigs": [
+                        {
+                            "EndpointConfigName": "config-new",
+                            "EndpointConfigArn": "arn:config-new",
+                            "CreationTime": self.now,
+                        }
+                    ]
+                },
+            ],
+            "list_models": [
+                {
+                    "Models": [
+                        {
+                            "ModelName": f"model-{i}",
+                            "ModelArn": f"arn:model-{i}",
+                            "CreationTime": old + timedelta(days=i),
+                        }
+                        for i in range(4)
+                    ]
+                }
+            ],
+            "list_tags": lambda ResourceArn: [
+                {"Tags": [{"Key": "keep", "Value": "true"}]}
+                if ResourceArn == "arn:model-1"
+                else {"Tags": []}
+            ],
+        }
+        sagemaker_client = _paged_client(pages)
+        sagemaker_client.describe_endpoint.return_value = {
+            "EndpointName": "endpoint",
+            "EndpointConfigName": "config-0",
+        }
+        sagemaker_client.describe_endpoint_config.side_effect = (
+            lambda EndpointConfigName: {
+                "ProductionVariants": [{"ModelName": f"model-{EndpointConfigName[-1]}"}]
+            }
+        )
+        sagemaker_client.describe_model.side_effect = lambda ModelName: {
+            "PrimaryContainer": {"ModelPackageName": f"arn:package/{ModelName}"}
+        }
+        return sagemaker_client
+
+    def test_dryrun(self):
+        sagemaker_client = self._sagemaker_client()
+        report = cleanup.SagemakerGarbageCollector(
+            sagemaker_client,
+            cleanup.RetentionPolicy(keep_last=0),
+            requests_per_second=1000,
+        ).collect(now=self.now)
+        # config-0 is used by the endpoint, config-new is too young
+        assert report.endpoint_configs == ["config-1", "config-2"]
+        # model-0 is used by config-0
+        assert report.models == ["model-1", "model-2", "model-3"]
+        assert report.referenced_packages == ["arn:package/model-0"]
+        sagemaker_client.delete_model.assert_not_called()
+        sagemaker_client.delete_endpoint_config.assert_not_called()
+
+    def test_retention_and_delete(self):
+        sagemaker_client = self._sagemaker_client()
+        report = cleanup.SagemakerGarbageCollector(
+            sagemaker_client,
+            cleanup.RetentionPolicy(keep_last=1, keep_tags={"keep": None}),
+            requests_per_second=1000,
+        ).collect(dryrun=False, now=self.now)
+        # config-new is the most recent unused one
+        assert report.endpoint_configs == ["config-1", "config-2"]
+        # model-3 is the most recent unused one, model-1 is tagged
+        assert report.models == ["model-2"]
+        assert sagemaker_client.delete_endpoint_config.call_count == 2
+        sagemaker_client.delete_model.assert_called_once_with(ModelName="model-2")
+
+    def test_models_of_failed_configs_are_kept(self):
+        sagemaker_client = self._sagemaker_client()
+
+        def delete_endpoint_config(EndpointConfigName):
+            if EndpointConfigName == "config-2":
+                raise ClientError(
+                    {"Error": {"Code": "ThrottlingException", "Message": ""}},
+                    "DeleteEndpointConfig",
+                )
+
+        sagemaker_client.delete_endpoint_config.side_effect = delete_endpoint_config
+        report = cleanup.SagemakerGarbageCollector(
+            sagemaker_client,
+            cleanup.RetentionPolicy(keep_last=0),
+            requests_per_second=1000,
+        ).collect(dryrun=False, now=self.now)
+        assert list(report.failed) == [("endpoint_config", "config-2")]
+        assert "Failed endpoint config config-2: " in report.summary()
+        # model-2 is still used by config-2
+        assert report.models == ["model-1", "model-3"]
+        assert report.kept["models"] == 2
+        assert report.referenced_packages == [
+            "arn:package/model-0",
+            "arn:package/model-2",
+        ]
+        assert sorted(
+            c.kwargs["ModelName"] for c in sagemaker_client.delete_model.call_args_list
+        ) == ["model-1", "model-3"]
+
+    def test_rate_limiter(self):
+        rate_limiter = cleanup.RateLimiter(requests_per_second=100, burst=1)
+        start = time.monotonic()
+        for _ in range(6):
+            rate_limiter.acquire()
+        assert time.monotonic() - start >= 0.05
+
+
+class TestProfiler:
+    origin = datetime(2023, 6, 1, tzinfo=timezone.utc)
+
+    def _at(self, seconds):
+        return self.origin + timedelta(seconds=seconds)
+
+    def _sagemaker_client(self):
+        steps = [
+            {
+                "StepName": "Eval",
+                "StepStatus": "Succeeded",
+                "StartTime": self._at(400),
+                "EndTime": self._at(401),
+                "CacheHitResult": {"SourcePipelineExecutionArn": "arn:execution/0"},
+                "Metadata": {"ProcessingJob": {"Arn": "arn:processing-job/eval"}},
+            },
+            {
+                "StepName": "Stats",
+                "StepStatus": "Succeeded",
+                "StartTime": self._at(100),
+                "EndTime": self._at(150),
+                "Metadata": {"ProcessingJob": {"Arn": "arn:processing-job/stats"}},
+            },
+            {
+                "StepName": "Train",
+                "StepStatus": "Succeeded",
+                "StartTime": self._at(100),
+                "EndTime": self._at(400),
+                "Metadata": {"TrainingJob": {"Arn": "arn:training-job/train"}},
+            },
+            {
+                "StepName": "Prep",
+                "StepStatus": "Succeeded",
+                "StartTime": self._at(0),
+                "EndTime": self._at(100),
+                "Metadata": {"ProcessingJob": {"Arn": "arn:processing-job/prep"}},
+            },
+        ]
+        pages = {
+            "list_pipeline_executions": [
+                {
+                    "PipelineExecutionSummaries": [
+                        {
+                            "PipelineExecutionArn": "arn:execution/2",
+                            "PipelineExecutionStatus": "Executing",
+                        },
+                        {
+                            "PipelineExecutionArn": "arn:execution/1",
+                            "PipelineExecutionStatus": "Succeeded",
+                        },
+                    ]
+                }
+            ],
+            "list_pipeline_execution_steps": [
+                {"PipelineExecutionSteps": steps[:2]},
+                {"PipelineExecutionSteps": steps[2:]},
+            ],
+        }
+        sagemaker_client = _paged_client(pages)
+        sagemaker_client.describe_pipeline_definition_for_execution.return_value = {
+            "PipelineDefinition": json.dumps(
+                {
+                    "Steps": [
+                        {"Name": "Prep", "Type": "Processing"},
+                        {"Name": "Stats", "Type": "Processing", "DependsOn": ["Prep"]},
+                        {"Name": "Train", "Type": "Training", "DependsOn": ["Prep"]},
+                        {"Name": "Eval", "Type": "Processing", "DependsOn": ["Train"]},
+                    ]
+                }
+            )
+        }
+        job_times = {"prep": (30, 100), "stats": (120, 150)}
+        sagemaker_client.describe_processing_job.side_effect = (
+            lambda ProcessingJobName: {
+                "ProcessingStartTime": self._at(job_times[ProcessingJobName][0]),
+                "ProcessingEndTime": self._at(job_times[ProcessingJobName][1]),
+            }
+        )
+        sagemaker_client.describe_training_job.return_value = {
+            "TrainingStartTime": self._at(160),
+            "TrainingEndTime": self._at(400),
+        }
+        return sagemaker_client
+
+    def test_fetch_and_cache(self, tmp_path):
+        sagemaker_client = self._sagemaker_client()
+        execution_profiler = PipelineProfiler(sagemaker_client, cache_dir=str(tmp_path))
+        profiles = execution_profiler.fetch("test_pipeline")
+        assert [p.arn for p in profiles] == ["arn:execution/2", "arn:execution/1"]
+        assert profiles[0].critical_path() == ["Prep", "Train", "Eval"]
+        # cache hit step is not described
+        assert sagemaker_client.describe_processing_job.call_count == 4
+
+        profiles = execution_profiler.fetch("test_pipeline", max_executions=2)
+        # only the running execution is fetched again
+        assert sagemaker_client.describe_training_job.call_count == 3
+        assert profiles[1].steps[0].name == "Eval"
+        assert (
+            execution_profiler.fetch("test_pipeline", max_executions=1)[0].arn
+            == "arn:execution/2"
+        )
+
+    def test_summary(self, tmp_path):
+        profiles = PipelineProfiler(
+            self._sagemaker_client(), cache_dir=str(tmp_path)
+        ).fetch("test_pipeline")
+        table = profiler.steps_table(profiles)
+        train = table[table["step"] == "Train"][0]
+        assert (train["duration"], train["queue_time"], train["run_time"]) == (
+            300,
+            60,
+            240,
+        )
+
+        summary = profiler.step_summary(profiles)
+        assert list(summary["step"]) == ["Train", "Prep", "Eval", "Stats"]
+        assert summary[2]["cache_hit_rate"] == 1.0
+        assert summary[3]["critical_share"] == 0.0
+
+        profiler.write_csv(summary, str(tmp_path / "summary.csv"))
+        with open(tmp_path / "summary.csv") as csv_file:
+            assert csv_file.readline().startswith("step,count,duration_mean")
+
+    def test_chrome_trace(self, tmp_path):
+        profiles = PipelineProfiler(
+            self._sagemaker_client(), cache_dir=str(tmp_path)
+        ).fetch("test_pipeline", max_executions=1)
+        paths = profiler.write_chrome_traces(profiles, str(tmp_path / "traces"))
+        with open(paths[0]) as trace_file:
+            events = json.load(trace_file)["traceEvents"]
+        train = next(e for e in events if e["name"] == "Train")
+        assert (train["ts"], train["dur"]) == (100e6, 300e6)
+        assert train["args"]["critical"]
+        assert len([e for e in events if e["name"] == "queue"]) == 3
+
+
+class TestLineage:
+    package_arn = "arn:aws:sagemaker:us-east-1:123456789000:model-package/abalone/1"
+    execution_arn = "arn:aws:sagemaker:us-east-1:123456789000:pipeline/p/execution/e1"
+
+    def _sagemaker_client(self, endpoints=("Endpoint",)):
+        pages = {
+            "list_pipeline_executions": [
+                {
+                    "PipelineExecutionSummaries": [
+                        {
+                            "PipelineExecutionArn": self.execution_arn,
+                            "PipelineExecutionStatus": "Succeeded",
+                        }
+                    ]
+                }
+            ],
+            "list_pipeline_execution_steps": [
+                {
+                    "PipelineExecutionSteps": [
+                        {
+                            "StepName": "Prep",
+                            "Metadata": {
+                                "ProcessingJob": {"Arn": "arn:processing-job/prep-job"}
+                            },
+                        },
+                        {
+                            "StepName": "Train",
+                            "Metadata": {
+                                "TrainingJob": {"Arn": "arn:training-job/train-job"}
+                            },
+                        },
+                        {
+                            "StepName": "Register",
+                            "Metadata": {"RegisterModel": {"Arn": self.package_arn}},
+                        },
+                    ]
+                }
+            ],
+            "list_endpoints": [
+                {"Endpoints": [{"EndpointName": name} for name in endpoints]}
+            ],
+        }
+        sagemaker_client = _paged_client(pages)
+        sagemaker_client.describe_processing_job.return_value = {
+            "ProcessingJobStatus": "Completed",
+            "ProcessingInputs": [{"S3Input": {"S3Uri": "s3://b/raw"}}],
+            "ProcessingOutputConfig": {
+                "Outputs": [{"S3Output": {"S3Uri": "s3://b/prep/train"}}]
+            },
+        }
+        sagemaker_client.describe_training_job.return_value = {
+            "TrainingJobStatus": "Completed",
+            "InputDataConfig": [
+                {"DataSource": {"S3DataSource": {"S3Uri": "s3://b/prep/train/"}}}
+            ],
+            "ModelArtifacts": {"S3ModelArtifacts": "s3://b/model/model.tar.gz"},
+        }
+        sagemaker_client.describe_model_package.return_value = {
+            "ModelPackageGroupName": "abalone",
+            "InferenceSpecification": {
+                "Containers": [{"ModelDataUrl": "s3://b/model/model.tar.gz"}]
+            },
+        }
+        sagemaker_client.describe_endpoint.return_value = {
+            "EndpointName": "Endpoint",
+            "EndpointConfigName": "endpoint-config",
+        }
+        sagemaker_client.describe_endpoint_config.return_value = {
+            "ProductionVariants": [{"ModelName": "Model"}]
+        }
+        sagemaker_client.describe_model.return_value = {
+            "PrimaryContainer": {"ModelPackageName": self.package_arn}
+        }
+        return sagemaker_client
+
+    def test_endpoint_lineage(self):
+        graph = lineage.LineageGraph()
+        lineage.LineageCollector(self._sagemaker_client(), graph).refresh(["p"])
+
+        result = lineage.endpoint_lineage(graph, "endpoint")
+        assert [n.name for n in result[lineage.PIPELINE_EXECUTION]] == [
+            self.execution_arn
+        ]
+        assert [n.name for n in result["dataset"]] == ["s3://b/raw"]
+        assert [n.name for n in result[lineage.TRAINING_JOB]] == ["train-job"]
+        assert result[lineage.MODEL_PACKAGE][0].properties["group"] == "abalone"
+
+        downstream = graph.downstream(
+            lineage.node_id(lineage.ARTIFACT, "s3://b/raw"), lineage.ENDPOINT
+        )
+        assert [n.name for n in downstream] == ["Endpoint"]
+
+    def test_deleted_resources(self, tmp_path):
+        sagemaker_client = self._sagemaker_client()
+        sagemaker_client.describe_model.side_effect = ClientError(
+            {
+                "Error": {
+                    "Code": "ValidationException",
+                    "Message": "Could not find model",
+                }
+            },
+            "DescribeModel",
+        )
+        graph = lineage.LineageGraph(str(tmp_path / "lineage.db"))
+        collector = lineage.LineageCollector(sagemaker_client, graph)
+        collector.refresh(["p"])
+
+        model = graph.get_node(lineage.node_id(lineage.MODEL, "Model"))
+        assert model.properties == {"deleted": True}
+        result = lineage.endpoint_lineage(graph, "endpoint")
+        assert [n.name for n in result[lineage.MODEL]] == ["Model"]
+        # the model package is still reached through the pipeline execution
+        package = graph.get_node(
+            lineage.node_id(lineage.MODEL_PACKAGE, self.package_arn)
+        )
+        assert package.properties["group"] == "abalone"
+
+        collector.refresh(["p"])
+        assert sagemaker_client.describe_model.call_count == 1
+
+    def test_deleted_model_package(self):
+        sagemaker_client = self._sagemaker_client()
+        sagemaker_client.describe_model_package.side_effect = ClientError(
+            {
+                "Error": {
+                    "Code": "ValidationException",
+                    "Message": f"ModelPackage {self.package_arn} does not exist.",
+                }
+            },
+            "DescribeModelPackage",
+        )
+        graph = lineage.LineageGraph()
+        lineage.LineageCollector(sagemaker_client, graph).refresh(["p"])
+
+        package = graph.get_node(
+            lineage.node_id(lineage.MODEL_PACKAGE, self.package_arn)
+        )
+        assert package.properties == {"deleted": True}
+        result = lineage.endpoint_lineage(graph, "endpoint")
+        assert [n.name for n in result[lineage.MODEL_PACKAGE]] == [self.package_arn]
+
+    def test_deleted_endpoint(self):
+        graph = lineage.LineageGraph()
+        collector = lineage.LineageCollector(self._sagemaker_client(), graph)
+        collector.refresh(["p"])
+
+        collector.sagemaker_client = self._sagemaker_client(endpoints=())
+        collector.refresh(["p"])
+        endpoint_id = lineage.node_id(lineage.ENDPOINT, "Endpoint")
+        assert graph.get_node(endpoint_id).properties == {"deleted": True}
+        assert graph.upstream(endpoint_id) == []
+        downstream = graph.downstream(
+            lineage.node_id(lineage.ARTIFACT, "s3://b/raw"), lineage.ENDPOINT
+        )
+        assert downstream == []
+
+    def test_incremental_refresh(self, tmp_path):
+        sagemaker_client = self._sagemaker_client()
+        db_path = str(tmp_path / "lineage.db")
+        graph = lineage.LineageGraph(db_path)
+        lineage.LineageCollector(sagemaker_client, graph).refresh(["p"])
+        graph.close()
+
+        sagemaker_client.describe_endpoint.return_value = {
+            "EndpointName": "Endpoint",
+            "EndpointConfigName": "endpoint-config-2",
+        }
+        graph = lineage.LineageGraph(db_path)
+        lineage.LineageCollector(sagemaker_client, graph).refresh(["p"])
+        assert sagemaker_client.get_paginator.call_count == 5
+        assert sagemaker_client.describe_processing_job.call_count == 1
+        assert sagemaker_client.describe_model.call_count == 1
+        assert sagemaker_client.describe_endpoint.call_count == 2
+        configs = graph.upstream(
+            lineage.node_id(lineage.ENDPOINT, "endpoint"), lineage.ENDPOINT_CONFIG
+        )
+        assert [n.name for n in configs] == ["endpoint-config-2"]
+
+
+class TestNotebooks:
+    role = "arn:aws:iam::123456789000:role/AmazonSageMaker-ExecutionRole"
+
+    def _write_notebook(
+        self, path, body="print(input_dir, output_dir, range(epochs), rate, name)"
+    ):
+        notebook = {
+            "cells": [
+                {"cell_type": "markdown", "metadata": {}, "source": ["# Abalone"]},
+                {
+                    "cell_type": "code",
+                    "metadata": {"tags": ["parameters"]},
+                    "source": [
+                        "input_dir = 'data'\n",
+                        "epochs = 10\n",
+                        "rate = 0.5\n",
+                        "name = 'abalone'",
+                    ],
+                    "outputs": [],
+                },
+                {
+                    "cell_type": "code",
+                    "metadata": {},
+                    "source": f"%matplotlib inline\n!pip list\n{body}",
+                    "outputs": [{"output_type": "stream", "text": ["1\n"]}],
+                },
+            ],
+            "metadata": {},
+            "nbformat": 4,
+            "nbformat_minor": 5,
+        }
+        path.write_text(json.dumps(notebook))
+        return str(path)
+
+    def test_notebook_to_script(self, tmp_path):
+        notebook_path = self._write_notebook(tmp_path / "abalone.ipynb")
+        package = notebooks.NotebookPackager(cache_dir=str(tmp_path / "cache")).package(
+            notebook_path
+        )
+        script = (tmp_path / package.script).read_text()
+        assert "# %matplotlib inline\n# !pip list\n" in script
+        assert script.index("epochs = 10") < script.index("_sys.argv")
+
+        result = subprocess.run(
+            [
+                sys.executable,
+                package.script,
+                "--input_dir",
+                "in",
+                "--output_dir",
+                "out",
+                "--epochs",
+                "3",
+                "--rate",
+                "1",
+                "--name",
+                "007",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout == "in out range(0, 3) 1.0 007\n"
+
+    def test_magics(self, tmp_path):
+        notebook = {
+            "cells": [
+                {
+                    "cell_type": "code",
+                    "metadata": {},
+                    "source": "%%bash\nfor i in 1 2; do\n  echo $i\ndone",
+                },
+                {
+                    "cell_type": "code",
+                    "metadata": {},
+                    "source": "for i in range(2):\n    %time i\n    !echo $i\nprint('done')",
+                },
+            ],
+            "metadata": {},
+            "nbformat": 4,
+            "nbformat_minor": 5,
+        }
+        script = notebooks.notebook_to_script(notebook)
+        assert "# %%bash\n# for i in 1 2; do\n#   echo $i\n# done\n" in script
+        assert "    pass  # %time i\n    pass  # !echo $i\n" in script
+
+        (tmp_path / "script.py").write_text(script)
+        result = subprocess.run(
+            [sys.executable, str(tmp_path / "script.py")],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout == "done\n"
+
+    def test_conversion_cache_and_upload(self, tmp_path):
+        s3_client = FakeS3Client()
+        notebook_path = self._write_notebook(tmp_path / "my project.ipynb")
+        packager = notebooks.NotebookPackager(
+            s3_client, "s3://bucket/code/", str(tmp_path / "cache")
+        )
+        first = packager.package(notebook_path)
+        assert (first.name, first.converted, first.uploaded) == (
+            "my-project",
+            True,
+            True,
+        )
+        assert first.code == f"s3://bucket/code/{first.digest}/my_project.py"
+
+        # outputs do not affect the digest
+        notebook = json.loads((tmp_path / "my project.ipynb").read_text())
+        notebook["cells"][2]["outputs"] = []
+        (tmp_path / "my project.ipynb").write_text(json.dumps(notebook))
+        requests_count = len(s3_client.requests)
+        second = packager.package(notebook_path)
+        assert second == dataclasses.replace(first, converted=False, uploaded=False)
+        assert len(s3_client.requests) == requests_count
+
+        self._write_notebook(tmp_path / "my project.ipynb", body="print(epochs)")
+        third = packager.package(notebook_path)
+        assert third.digest != first.digest and third.converted and third.uploaded
+
+    def test_build_pipeline_package(self, tmp_path, monkeypatch):
+        notebook_paths = [
+            self._write_notebook(tmp_path / f"{name}.ipynb", f"print('{name}')")
+            for name in ("preprocess", "train")
+        ]
+        packages = notebooks.build_pipeline_package(
+            notebook_paths,
+            str(tmp_path / "notebook_pipeline"),
+            packager=notebooks.NotebookPackager(cache_dir=str(tmp_path / "cache")),
+            conf={
+                "pipeline": {"input_data_s3_uri": "s3://bucket/raw"},
+                "processing": {"instance_type": "ml.m5.xlarge"},
+            },
+        )
+        assert [p.name for p in packages] == ["preprocess", "train"]
+
+        monkeypatch.syspath_prepend(str(tmp_path))
+        pipeline_module = importlib.import_module("notebook_pipeline.pipeline")
+        assert pipeline_module.get_pipeline is notebooks.get_notebook_pipeline
+        conf = helpers.get_pipeline_config(
+            pipeline_module, "pipeline.defaults", self.role, []
+        )
+        assert conf.pipeline.role == self.role
+        assert conf.processing.instance_type == "ml.m5.xlarge"
+        assert [s.code for s in conf.steps] == [p.script for p in packages]
+
+        sm_session = PipelineSession(
+            boto_session=MagicMock(region_name="us-east-1"),
+            sagemaker_client=MagicMock(),
+            default_bucket="bucket",
+        )
+        definition = json.loads(
+            pipeline_module.get_pipeline(
+                sm_session, "notebook-pipeline", conf
+            ).definition()
+        )
+        assert definition["Parameters"] == [
+            {
+                "Name": "InputDataS3Uri",
+                "Type": "String",
+                "DefaultValue": "s3://bucket/raw",
+            }
+        ]
+        steps = definition["Steps"]
+        assert [(s["Name"], s["Type"]) for s in steps] == [
+            ("preprocess", "Processing"),
+            ("train", "Processing"),
+        ]
+        inputs = [
+            {i["InputName"]: i["S3Input"] for i in s["Arguments"]["ProcessingInputs"]}
+            for s in steps
+        ]
+        assert inputs[0]["data"]["S3Uri"] == {"Get": "Parameters.InputDataS3Uri"}
+        assert inputs[1]["data"]["S3Uri"] == {
+            "Get": "Steps.preprocess.ProcessingOutputConfig.Outputs['output'].S3Output.S3Uri"
+        }
+        for step, package in zip(steps, packages):
+            arguments = step["Arguments"]
+            assert (
+                arguments["ProcessingResources"]["ClusterConfig"]["InstanceType"]
+                == "ml.m5.xlarge"
+            )
+            assert arguments["AppSpecification"]["ContainerEntrypoint"] == [
+                "python3",
+                f"/opt/ml/processing/input/code/{os.path.basename(package.script)}",
+            ]
+            assert arguments["AppSpecification"]["ContainerArguments"] == [
+                "--input_dir",
+                notebooks.INPUT_DIR,
+                "--output_dir",
+                notebooks.OUTPUT_DIR,
+            ]